@@ -0,0 +1,156 @@
+"""NumPy version of the analytic solution in functions.stan.
+
+yt gives the same total cell density as yt in functions.stan, but takes
+arrays and broadcasts, so it can be evaluated for every posterior draw,
+replicate and time point at once without a CmdStan run.
+
+To check it against the yhat values that Stan saved for a run, and to time a
+prediction on a dense grid of time points, run e.g.
+
+    python analytic_solution.py tunicamycin m2 ab
+
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import xarray as xr
+
+from fit_models import (INFD_DIR, RAW_DATA_DIR, STAN_FILES, TREATMENTS,
+                        StanData)
+from munging import load_prepared_data
+from stream_netcdf import open_infd
+
+GRID_POINTS = 200
+RATE_PARAMETERS = ["R0", "mu", "log_kq", "log_td", "log_kd"]
+
+
+def yt(t, R0, mu, kq, td, kd):
+    """Total cell density at time t, i.e. Rt + Qat + Qct in functions.stan.
+
+    With sm = mu - kq, a = kq * R0 / sm, b = kq * R0 / (sm + kd) and
+    U = 1 if t >= td else 0, the terms of functions.stan's yt are rearranged
+    as
+
+        (R0 + a) * exp(sm * t) - a
+        + U * ((b - a) * exp(sm * (t - td)) + a - b * exp(-kd * (t - td)))
+
+    so that only three exponentials are needed per element, and the large
+    arrays are updated in place.
+
+    """
+    sm = mu - kq
+    a = kq * R0 / sm
+    b = kq * R0 / (sm + kd)
+    delay = t - td
+    after = np.exp(sm * delay)
+    after *= b - a
+    after += a
+    decay = np.multiply(-kd, delay)
+    np.exp(decay, out=decay)
+    decay *= b
+    after -= decay
+    after *= delay >= 0
+    out = np.exp(sm * t)
+    out *= R0 + a
+    out -= a
+    out += after
+    return out
+
+
+def get_rates(posterior, clones):
+    """Get mu and the kq, td and kd of each clone in clones, for every draw.
+
+    clones are 1-based clone codes, as in a stan input. The outputs have
+    shape (chain, draw) for mu and (chain, draw, len(clones)) for the rest.
+
+    """
+    c = np.asarray(clones) - 1
+    return (
+        posterior["mu"].values,
+        np.exp(posterior["log_kq"].values[..., c]),
+        np.exp(posterior["log_td"].values[..., c]),
+        np.exp(posterior["log_kd"].values[..., c]),
+    )
+
+
+def predict_observations(posterior, replicate_clone, replicate, t):
+    """Get yt for every draw at each observation, like yhat in the models.
+
+    replicate_clone is each replicate's clone code and replicate and t are
+    each observation's replicate code and time, as in a stan input.
+
+    """
+    r = np.asarray(replicate) - 1
+    mu, kq, td, kd = get_rates(posterior, np.asarray(replicate_clone)[r])
+    R0 = posterior["R0"].values[..., r]
+    return yt(np.asarray(t), R0, mu[..., None], kq, td, kd)
+
+
+def predict_timecourses(posterior, replicate_clone, t):
+    """Get yt for every draw, replicate and time point in t.
+
+    Returns a DataArray with dimensions chain, draw, replicate and time.
+
+    """
+    mu, kq, td, kd = get_rates(posterior, replicate_clone)
+    t = np.asarray(t)
+    y = yt(
+        t,
+        posterior["R0"].values[..., None],
+        mu[..., None, None],
+        kq[..., None],
+        td[..., None],
+        kd[..., None],
+    )
+    return xr.DataArray(
+        y,
+        dims=["chain", "draw", "replicate", "time"],
+        coords={
+            "chain": posterior["chain"].values,
+            "draw": posterior["draw"].values,
+            "replicate": posterior["R0"][posterior["R0"].dims[-1]].values,
+            "time": t,
+        },
+    )
+
+
+def main(treatment_label, model_name, xname, n_grid=GRID_POINTS):
+    """Compare yt with a run's saved yhat and time a dense-grid prediction."""
+    run_name = f"{treatment_label}_{model_name}_{xname}"
+    infd_file = os.path.join(INFD_DIR, f"infd_{run_name}.nc")
+    posterior = open_infd(
+        infd_file, {"posterior": RATE_PARAMETERS + ["yhat"]}
+    ).posterior
+    if "yhat" not in posterior:
+        raise ValueError(
+            f"{infd_file} has no yhat: refit with --output-profile full to check it."
+        )
+    msmts = load_prepared_data(RAW_DATA_DIR, TREATMENTS[treatment_label])
+    stan_data = StanData(msmts, "design_" + xname)
+    yhat = predict_observations(
+        posterior, stan_data.replicate_clone, stan_data.replicate, stan_data.t
+    )
+    rel_error = np.abs(yhat - posterior["yhat"].values) / posterior["yhat"].values
+    print(f"Largest relative difference from Stan's yhat: {rel_error.max():.2e}")
+    grid = np.linspace(0, stan_data.t.max(), n_grid)
+    start = time.perf_counter()
+    y = predict_timecourses(posterior, stan_data.replicate_clone, grid)
+    seconds = time.perf_counter() - start
+    print(f"Predicted {y.size} values, with shape {dict(y.sizes)}, in {seconds:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the numpy solution.")
+    parser.add_argument("treatment", choices=list(TREATMENTS.keys()))
+    parser.add_argument("model", choices=list(STAN_FILES.keys()))
+    parser.add_argument("xname", choices=["ab", "abc", "null"])
+    parser.add_argument(
+        "--grid",
+        type=int,
+        default=GRID_POINTS,
+        help="Number of time points in the timing test.",
+    )
+    args = parser.parse_args()
+    main(args.treatment, args.model, args.xname, args.grid)
@@ -0,0 +1,68 @@
+"""Fingerprints for pipeline artifacts.
+
+Every artifact (inference data, loo results, comparisons, plots) can have a
+sidecar file holding a fingerprint of the inputs it was made from. A stage can
+be skipped if all of its artifacts have sidecars that match the current
+inputs.
+
+The sidecar is removed before an artifact is written and only written back
+once the artifact is complete, so an artifact left behind by an interrupted
+run never looks up to date.
+
+"""
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+FINGERPRINT_SUFFIX = ".fingerprint"
+
+
+def _to_json(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Cannot fingerprint object of type {type(obj)}.")
+
+
+def get_fingerprint(*parts):
+    """Hash some json-serialisable things, e.g. a stan input dictionary."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(json.dumps(part, sort_keys=True, default=_to_json).encode())
+    return h.hexdigest()
+
+
+def get_file_hash(path):
+    """Hash the contents of a file."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def read_fingerprint(path):
+    """Get the fingerprint of an artifact, or None if it doesn't have one."""
+    sidecar = path + FINGERPRINT_SUFFIX
+    if not (os.path.exists(path) and os.path.exists(sidecar)):
+        return None
+    with open(sidecar, "r") as f:
+        return f.read().strip()
+
+
+def is_fresh(path, fingerprint):
+    """Check if an artifact exists and was made from the current inputs."""
+    return read_fingerprint(path) == fingerprint
+
+
+@contextmanager
+def writing(path, fingerprint):
+    """Context for writing an artifact, recording its fingerprint afterwards."""
+    sidecar = path + FINGERPRINT_SUFFIX
+    if os.path.exists(sidecar):
+        os.remove(sidecar)
+    yield path
+    with open(sidecar + ".tmp", "w") as f:
+        f.write(fingerprint)
+    os.replace(sidecar + ".tmp", sidecar)
@@ -0,0 +1,94 @@
+"""Measure how many gradient evaluations per second each model achieves.
+
+Every leapfrog step costs one gradient evaluation, so the number of gradient
+evaluations in a chain is the sum of n_leapfrog__ over all of its iterations,
+including warmup. This is divided by the chain's sampling time as reported by
+CmdStan.
+
+To compare two versions of the models, benchmark each with a different label,
+e.g. using a checkout of the old version made with `git worktree`:
+
+    git worktree add ../apoptosis_before HEAD~1
+    python benchmark_gradients.py --label before --stan-dir ../apoptosis_before
+    python benchmark_gradients.py --label after
+
+"""
+import argparse
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from cmdstanpy.utils import get_logger
+
+from fit_models import (OUTPUT_DIR, PRIORS, RAW_DATA_DIR, SAMPLE_CONFIG,
+                        SAMPLES_DIR, STAN_FILES, TREATMENTS, get_stan_input)
+from munging import load_prepared_data
+from stan_models import get_model
+
+BENCHMARK_DIR = os.path.join(OUTPUT_DIR, "benchmarks")
+BENCHMARK_RUNS = [
+    ("puromycin", "m1", "abc"),
+    ("puromycin", "m2", "abc"),
+    ("puromycin", "null", "null"),
+]
+TOTAL_TIME_REGEX = re.compile(r"([\d.]+) seconds \(Total\)")
+
+
+def get_elapsed_time(csv_file):
+    """Get the total warmup and sampling time from a CmdStan csv file."""
+    with open(csv_file, "r") as f:
+        return float(TOTAL_TIME_REGEX.search(f.read()).group(1))
+
+
+def benchmark_run(treatment_label, model_name, xname, stan_dir):
+    """Sample from one run, returning one row of results per chain."""
+    run_name = f"{treatment_label}_{model_name}_{xname}"
+    model = get_model(os.path.join(stan_dir, STAN_FILES[model_name]))
+    msmts = load_prepared_data(RAW_DATA_DIR, TREATMENTS[treatment_label])
+    stan_input = get_stan_input(msmts, PRIORS, "design_" + xname)
+    mcmc = model.sample(
+        data=stan_input,
+        **{
+            **SAMPLE_CONFIG,
+            "save_warmup": True,
+            "output_dir": os.path.join(SAMPLES_DIR, "benchmarks", run_name),
+        },
+    )
+    n_leapfrog = mcmc.draws(inc_warmup=True)[
+        :, :, mcmc.column_names.index("n_leapfrog__")
+    ].sum(axis=0)
+    elapsed = np.array([get_elapsed_time(f) for f in mcmc.runset.csv_files])
+    return pd.DataFrame(
+        {
+            "run": run_name,
+            "chain": mcmc.chain_ids,
+            "gradient_evals": n_leapfrog,
+            "seconds": elapsed,
+            "gradient_evals_per_second": n_leapfrog / elapsed,
+        }
+    )
+
+
+def main(label, stan_dir):
+    get_logger().setLevel(40)
+    results = pd.concat(
+        [
+            benchmark_run(treatment_label, model_name, xname, stan_dir)
+            for treatment_label, model_name, xname in BENCHMARK_RUNS
+        ],
+        ignore_index=True,
+    )
+    print(results.groupby("run")[["gradient_evals_per_second"]].mean())
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    results.to_csv(os.path.join(BENCHMARK_DIR, f"gradients_{label}.csv"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark model gradients.")
+    parser.add_argument("--label", default="current", help="Name for the results.")
+    parser.add_argument(
+        "--stan-dir", default=".", help="Directory containing the Stan files."
+    )
+    args = parser.parse_args()
+    main(args.label, args.stan_dir)
@@ -0,0 +1,122 @@
+"""Compare the original and reparameterised models' sampling efficiency.
+
+Each run in benchmark_gradients.BENCHMARK_RUNS is fitted three ways:
+
+- original: the current models with fit_models.SAMPLE_CONFIG, whose
+  adapt_delta is 0.99.
+- original_default_adapt_delta: the current models at adapt_delta 0.8.
+- reparameterised: the "_rp" models at adapt_delta 0.8, as fit_models.py
+  --reparameterised does.
+
+For each fit the number of divergent transitions and of iterations hitting
+the maximum tree depth, the mean tree depth and step size, and CmdStan's
+total warmup and sampling time, summed over chains, are recorded. So are the
+posterior mean, sd, bulk and tail ESS, and ESS per second, of each element of
+PARAMETERS. The posterior means should agree between variants, as the
+reparameterised models have the same posterior as the original ones.
+
+"""
+import argparse
+import os
+
+import arviz as az
+import pandas as pd
+from cmdstanpy.utils import get_logger
+
+from benchmark_gradients import BENCHMARK_DIR, BENCHMARK_RUNS, get_elapsed_time
+from fit_models import (DEFAULT_ADAPT_DELTA, PRIORS, RAW_DATA_DIR,
+                        REPARAMETERISED_SUFFIX, SAMPLE_CONFIG, SAMPLES_DIR,
+                        STAN_FILES, TREATMENTS, get_stan_input)
+from munging import load_prepared_data, update_prepared_data
+from stan_models import get_model, write_stan_json
+
+VARIANTS = {
+    "original": ("", SAMPLE_CONFIG["adapt_delta"]),
+    "original_default_adapt_delta": ("", DEFAULT_ADAPT_DELTA),
+    "reparameterised": (REPARAMETERISED_SUFFIX, DEFAULT_ADAPT_DELTA),
+}
+PARAMETERS = ["mu", "qconst", "tconst", "dconst", "dq_free", "dt_free", "dd_free"]
+MAX_TREEDEPTH = 10  # CmdStan's default
+OUTPUT_DIR = os.path.join(SAMPLES_DIR, "benchmarks", "parameterisations")
+
+
+def benchmark_variant(treatment_label, model_name, xname, variant):
+    """Fit one run with one variant, returning a summary and parameter table."""
+    suffix, adapt_delta = VARIANTS[variant]
+    run_name = f"{treatment_label}_{model_name}_{xname}"
+    output_dir = os.path.join(OUTPUT_DIR, run_name, variant)
+    os.makedirs(output_dir, exist_ok=True)
+    json_file = os.path.join(output_dir, "input_data.json")
+    msmts = load_prepared_data(RAW_DATA_DIR, TREATMENTS[treatment_label])
+    stan_input = get_stan_input(
+        msmts, PRIORS, "design_" + xname, output_profile="diagnostics-only"
+    )
+    write_stan_json(json_file, stan_input)
+    mcmc = get_model(STAN_FILES[model_name + suffix]).sample(
+        data=json_file,
+        **{**SAMPLE_CONFIG, "adapt_delta": adapt_delta, "output_dir": output_dir},
+    )
+    seconds = sum(get_elapsed_time(f) for f in mcmc.runset.csv_files)
+    draws = mcmc.draws()
+    divergent, tree_depth, step_size = (
+        draws[:, :, mcmc.column_names.index(c)]
+        for c in ["divergent__", "treedepth__", "stepsize__"]
+    )
+    infd = az.from_cmdstanpy(mcmc)
+    var_names = [p for p in PARAMETERS if p in infd.posterior]
+    params = az.summary(infd, var_names=var_names)[
+        ["mean", "sd", "ess_bulk", "ess_tail", "r_hat"]
+    ]
+    for method in ["bulk", "tail"]:
+        params[f"ess_{method}_per_second"] = params[f"ess_{method}"] / seconds
+    summary = {
+        "run": run_name,
+        "variant": variant,
+        "adapt_delta": adapt_delta,
+        "seconds": seconds,
+        "divergences": int(divergent.sum()),
+        "max_treedepth_hits": int((tree_depth >= MAX_TREEDEPTH).sum()),
+        "mean_tree_depth": tree_depth.mean(),
+        "mean_step_size": step_size.mean(),
+        "min_ess_bulk_per_second": params["ess_bulk_per_second"].min(),
+        "min_ess_tail_per_second": params["ess_tail_per_second"].min(),
+    }
+    params = params.rename_axis("parameter").reset_index()
+    params.insert(0, "variant", variant)
+    params.insert(0, "run", run_name)
+    return summary, params
+
+
+def main(label):
+    get_logger().setLevel(40)
+    update_prepared_data(RAW_DATA_DIR)
+    summaries = []
+    params = []
+    for treatment_label, model_name, xname in BENCHMARK_RUNS:
+        for variant in VARIANTS.keys():
+            print(f"Fitting {treatment_label} {model_name} {xname}, {variant}...")
+            summary, variant_params = benchmark_variant(
+                treatment_label, model_name, xname, variant
+            )
+            summaries.append(summary)
+            params.append(variant_params)
+    summaries = pd.DataFrame(summaries)
+    params = pd.concat(params, ignore_index=True)
+    print(summaries.to_string(index=False))
+    print("Posterior means:")
+    print(params.pivot_table("mean", ["run", "parameter"], "variant").to_string())
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    summaries.to_csv(
+        os.path.join(BENCHMARK_DIR, f"parameterisations_{label}.csv"), index=False
+    )
+    params.to_csv(
+        os.path.join(BENCHMARK_DIR, f"parameterisations_params_{label}.csv"),
+        index=False,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare parameterisations.")
+    parser.add_argument("--label", default="current", help="Name for the results.")
+    args = parser.parse_args()
+    main(args.label)
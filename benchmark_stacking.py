@@ -0,0 +1,108 @@
+"""Compare the speed of loo_compare.stacking_weights with the old loop version.
+
+The old version, copied here as stacking_weights_loop, computed the stacking
+objective and its gradient with python loops over observations and models.
+Both versions are run on random matrices of pointwise elpds of different
+sizes. The loop version is skipped for sizes where it would take too long.
+
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+
+from benchmark_gradients import BENCHMARK_DIR
+from loo_compare import stacking_weights
+
+SIZES = [(50, 5), (500, 5), (1000, 20), (5000, 100), (5000, 300)]
+MAX_LOOP_SIZE = 20000  # largest rows * cols to run the loop version for
+SEED = 12345
+
+
+def stacking_weights_loop(ic_i_val):
+    """The stacking weights as computed before vectorisation."""
+    rows, cols = ic_i_val.shape
+
+    def w_fuller(weights):
+        return np.concatenate((weights, [max(1.0 - np.sum(weights), 0.0)]))
+
+    def log_score(weights):
+        w_full = w_fuller(weights)
+        score = 0.0
+        for i in range(rows):
+            score += np.log(np.dot(exp_ic_i[i], w_full))
+        return -score
+
+    def gradient(weights):
+        w_full = w_fuller(weights)
+        grad = np.zeros(km1)
+        for k in range(km1):
+            for i in range(rows):
+                grad[k] += (exp_ic_i[i, k] - exp_ic_i[i, km1]) / np.dot(
+                    exp_ic_i[i], w_full
+                )
+        return -grad
+
+    exp_ic_i = np.exp(ic_i_val)
+    km1 = cols - 1
+    theta = np.full(km1, 1.0 / cols)
+    bounds = [(0.0, 1.0) for _ in range(km1)]
+    constraints = [
+        {"type": "ineq", "fun": lambda x: -np.sum(x) + 1.0},
+        {"type": "ineq", "fun": np.sum},
+    ]
+    weights = minimize(
+        fun=log_score, x0=theta, jac=gradient, bounds=bounds, constraints=constraints
+    )
+    return w_fuller(weights["x"])
+
+
+def get_ic_i_val(rows, cols, rng, offset=0):
+    """Get some pointwise elpds where the models differ a bit."""
+    model_effect = rng.normal(0, 0.2, size=cols)
+    return offset - np.abs(rng.normal(1, 0.5, size=(rows, cols)) + model_effect)
+
+
+def time_function(f, ic_i_val):
+    start = time.perf_counter()
+    weights = f(ic_i_val)
+    return time.perf_counter() - start, weights
+
+
+def main(label):
+    rng = np.random.default_rng(SEED)
+    results = []
+    for rows, cols in SIZES:
+        ic_i_val = get_ic_i_val(rows, cols, rng)
+        seconds, weights = time_function(stacking_weights, ic_i_val)
+        row = {
+            "rows": rows,
+            "cols": cols,
+            "seconds_vectorised": seconds,
+            "seconds_loop": np.nan,
+            "max_weight_difference": np.nan,
+        }
+        if rows * cols <= MAX_LOOP_SIZE:
+            seconds_loop, weights_loop = time_function(stacking_weights_loop, ic_i_val)
+            row["seconds_loop"] = seconds_loop
+            row["max_weight_difference"] = np.abs(weights - weights_loop).max()
+        results.append(row)
+    results = pd.DataFrame(results)
+    print(results)
+    # very negative pointwise elpds underflow in the loop version
+    ic_i_val = get_ic_i_val(50, 5, rng, offset=-800)
+    print("Weights with elpds around -800:")
+    print("  vectorised:", stacking_weights(ic_i_val).round(3))
+    print("  loop:      ", stacking_weights_loop(ic_i_val).round(3))
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    results.to_csv(os.path.join(BENCHMARK_DIR, f"stacking_{label}.csv"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark stacking weights.")
+    parser.add_argument("--label", default="current", help="Name for the results.")
+    args = parser.parse_args()
+    main(args.label)
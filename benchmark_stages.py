@@ -0,0 +1,280 @@
+"""Measure how long each stage of the pipeline takes and how much memory it uses.
+
+The runs in benchmark_gradients.BENCHMARK_RUNS go through the same stages as
+in fit_models.py, run_reloo_analysis.py and draw_plots.py:
+
+- compile: compiling the model from scratch, in an empty cache.
+- sample: model.sample with fit_models.SAMPLE_CONFIG.
+- inference_data: writing the inference data with stream_to_netcdf.
+- loo: az.loo.
+- reloo: run_reloo_analysis.run_reloo, refitting one replicate at a time.
+- draw_plots: drawing the run's trace, design and pareto k figures.
+- compare: loo_compare.compare for each treatment's reloo results.
+
+Each stage runs in a fresh process, so its peak resident memory can be
+measured on its own. peak_rss_mb is for the python process and
+peak_child_rss_mb is for the largest CmdStan process it ran, if any. Both
+include the memory used by python and the imported packages. The bulk and
+tail ESS per second of sampling is recorded for ESS_PARAMETERS, using the
+smallest value for vector parameters.
+
+Results are written to csv files in BENCHMARK_DIR, named with --label. To find
+regressions between two commits, benchmark each one with a different label and
+then pass the older label as --baseline, e.g.
+
+    git checkout HEAD~1
+    python benchmark_stages.py --label before
+    git checkout -
+    python benchmark_stages.py --label after --baseline before
+
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import arviz as az
+import numpy as np
+import pandas as pd
+from cmdstanpy.utils import get_logger
+
+from benchmark_gradients import BENCHMARK_DIR, BENCHMARK_RUNS
+from draw_plots import draw_figure, plot_khat, plot_run_design_qs, plot_trace
+from fit_models import (PRIORS, RAW_DATA_DIR, SAMPLE_CONFIG, SAMPLES_DIR,
+                        STAN_FILES, TREATMENTS, StanData, get_infd_kwargs,
+                        get_stan_input)
+from loo_compare import compare
+from munging import load_prepared_data, update_prepared_data
+from run_reloo_analysis import PARAMETERS, CustomSamplingWrapper, run_reloo
+from run_reloo_analysis import SAMPLE_CONFIG as RELOO_SAMPLE_CONFIG
+from stan_models import build_models, get_model, write_stan_json
+from stream_netcdf import open_infd, stream_to_netcdf
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+STAGE_DIR = os.path.join(SAMPLES_DIR, "benchmarks", "stages")
+RUN_STAGES = ["compile", "sample", "inference_data", "loo", "reloo", "draw_plots"]
+ESS_PARAMETERS = ["tconst", "dconst", "dt_free", "dd_free", "mu"]
+STAGE_KEY = ["run", "stage"]
+ESS_KEY = ["run", "parameter"]
+
+
+def get_paths(run_name):
+    """Get the paths of a benchmark run's inputs and outputs."""
+    run_dir = os.path.join(STAGE_DIR, run_name)
+    return {
+        "run_dir": run_dir,
+        "json_file": os.path.join(run_dir, "input_data.json"),
+        "samples_dir": os.path.join(run_dir, "samples"),
+        "infd_file": os.path.join(run_dir, "infd.nc"),
+        "loo_file": os.path.join(run_dir, "loo.pkl"),
+        "reloo_file": os.path.join(run_dir, "reloo.pkl"),
+        "reloo_dir": os.path.join(run_dir, "reloo"),
+        "plot_dir": os.path.join(run_dir, "plots"),
+    }
+
+
+def load_run_data(treatment_label, xname, paths):
+    msmts = load_prepared_data(RAW_DATA_DIR, TREATMENTS[treatment_label])
+    with open(paths["json_file"], "r") as f:
+        stan_input = json.load(f)
+    return msmts, get_infd_kwargs(msmts, "design_" + xname, stan_input)
+
+
+def stage_compile(treatment_label, model_name, xname):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        get_model(STAN_FILES[model_name], cache_dir=cache_dir)
+
+
+def stage_sample(treatment_label, model_name, xname):
+    paths = get_paths(f"{treatment_label}_{model_name}_{xname}")
+    msmts = load_prepared_data(RAW_DATA_DIR, TREATMENTS[treatment_label])
+    write_stan_json(
+        paths["json_file"], get_stan_input(msmts, PRIORS, "design_" + xname)
+    )
+    get_model(STAN_FILES[model_name]).sample(
+        data=paths["json_file"],
+        **{**SAMPLE_CONFIG, "output_dir": paths["samples_dir"]},
+    )
+
+
+def stage_inference_data(treatment_label, model_name, xname):
+    paths = get_paths(f"{treatment_label}_{model_name}_{xname}")
+    _, infd_kwargs = load_run_data(treatment_label, xname, paths)
+    csv_files = sorted(glob(os.path.join(paths["samples_dir"], "*.csv")))
+    stream_to_netcdf(csv_files, paths["infd_file"], **infd_kwargs)
+
+
+def stage_loo(treatment_label, model_name, xname):
+    paths = get_paths(f"{treatment_label}_{model_name}_{xname}")
+    loo = az.loo(az.from_netcdf(paths["infd_file"]), pointwise=True)
+    loo.to_pickle(paths["loo_file"])
+
+
+def stage_reloo(treatment_label, model_name, xname):
+    paths = get_paths(f"{treatment_label}_{model_name}_{xname}")
+    msmts, infd_kwargs = load_run_data(treatment_label, xname, paths)
+    sw = CustomSamplingWrapper(
+        model=get_model(STAN_FILES[model_name]),
+        idata_orig=open_infd(paths["infd_file"], {"posterior": PARAMETERS}),
+        sample_kwargs=RELOO_SAMPLE_CONFIG,
+        idata_kwargs=infd_kwargs,
+        stan_data=StanData(msmts, "design_" + xname),
+        priors=PRIORS,
+        data_dir=os.path.join(paths["reloo_dir"], "input_data"),
+    )
+    rl = run_reloo(sw, pd.read_pickle(paths["loo_file"]), None, paths["reloo_dir"])
+    rl.to_pickle(paths["reloo_file"])
+
+
+def stage_draw_plots(treatment_label, model_name, xname):
+    run_name = f"{treatment_label}_{model_name}_{xname}"
+    paths = get_paths(run_name)
+    infd_file = paths["infd_file"]
+    jobs = {
+        "sampled_params": (plot_trace, (infd_file, ["avg_delay"], xname)),
+        "khat": (plot_khat, (paths["loo_file"], f"Pareto k: {run_name}")),
+    }
+    if xname != "null":
+        jobs["design_param_qs"] = (plot_run_design_qs, (infd_file,))
+        jobs["sampled_params_posterior"] = (
+            plot_trace,
+            (infd_file, ["tauD", "k_d"], xname),
+        )
+    os.makedirs(paths["plot_dir"], exist_ok=True)
+    for plot_name, (plot_function, args) in jobs.items():
+        plot_stem = os.path.join(paths["plot_dir"], plot_name)
+        draw_figure(plot_stem, plot_function, args, run_name, ["svg"])
+
+
+def stage_compare(treatment_label):
+    runs = [
+        f"{t}_{model_name}_{xname}"
+        for t, model_name, xname in BENCHMARK_RUNS
+        if t == treatment_label
+    ]
+    compare({r: pd.read_pickle(get_paths(r)["reloo_file"]) for r in runs})
+
+
+STAGE_FUNCTIONS = {
+    "compile": stage_compile,
+    "sample": stage_sample,
+    "inference_data": stage_inference_data,
+    "loo": stage_loo,
+    "reloo": stage_reloo,
+    "draw_plots": stage_draw_plots,
+    "compare": stage_compare,
+}
+
+
+def get_peak_rss_mb(who):
+    """Get the peak resident memory of this process or its children in MB."""
+    if resource is None:
+        return np.nan
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def time_stage(stage, *args):
+    """Run a stage, returning its wall time and peak memory."""
+    get_logger().setLevel(40)
+    start = time.perf_counter()
+    STAGE_FUNCTIONS[stage](*args)
+    seconds = time.perf_counter() - start
+    return {
+        "stage": stage,
+        "seconds": seconds,
+        "peak_rss_mb": get_peak_rss_mb(getattr(resource, "RUSAGE_SELF", None)),
+        "peak_child_rss_mb": get_peak_rss_mb(
+            getattr(resource, "RUSAGE_CHILDREN", None)
+        ),
+    }
+
+
+def run_stage_process(stage, *args):
+    """Run a stage in a new process, so that its peak memory is its own."""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(time_stage, stage, *args).result()
+
+
+def get_ess(run_name, sample_seconds):
+    """Get the bulk and tail ESS of ESS_PARAMETERS, and their rates."""
+    infd_file = get_paths(run_name)["infd_file"]
+    posterior = open_infd(infd_file, {"posterior": ESS_PARAMETERS}).posterior
+    ess = {method: az.ess(posterior, method=method) for method in ["bulk", "tail"]}
+    out = pd.DataFrame(
+        {
+            f"ess_{method}": {p: float(e[p].min()) for p in e.data_vars}
+            for method, e in ess.items()
+        }
+    )
+    for method in ess.keys():
+        out[f"ess_{method}_per_second"] = out[f"ess_{method}"] / sample_seconds
+    out = out.rename_axis("parameter").reset_index()
+    out.insert(0, "run", run_name)
+    return out
+
+
+def compare_to_baseline(results, baseline_file, key, columns):
+    """Get the ratio of some results to the same results from a baseline."""
+    baseline = pd.read_csv(baseline_file).set_index(key)[columns]
+    return (results.set_index(key)[columns] / baseline).add_suffix("_ratio")
+
+
+def main(label, baseline=None):
+    update_prepared_data(RAW_DATA_DIR)
+    build_models(list({STAN_FILES[m] for _, m, _ in BENCHMARK_RUNS}))
+    shutil.rmtree(STAGE_DIR, ignore_errors=True)
+    stages = []
+    ess = []
+    for treatment_label, model_name, xname in BENCHMARK_RUNS:
+        run_name = f"{treatment_label}_{model_name}_{xname}"
+        os.makedirs(get_paths(run_name)["run_dir"])
+        for stage in RUN_STAGES:
+            print(f"Benchmarking stage {stage} for run {run_name}...")
+            row = run_stage_process(stage, treatment_label, model_name, xname)
+            stages.append({"run": run_name, **row})
+            if stage == "sample":
+                sample_seconds = row["seconds"]
+        ess.append(get_ess(run_name, sample_seconds))
+    for treatment_label in dict.fromkeys(t for t, _, _ in BENCHMARK_RUNS):
+        print(f"Benchmarking stage compare for treatment {treatment_label}...")
+        row = run_stage_process("compare", treatment_label)
+        stages.append({"run": treatment_label, **row})
+    stages = pd.DataFrame(stages)
+    ess = pd.concat(ess, ignore_index=True)
+    print(stages.to_string(index=False))
+    print(ess.to_string(index=False))
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    stages.to_csv(os.path.join(BENCHMARK_DIR, f"stages_{label}.csv"), index=False)
+    ess.to_csv(os.path.join(BENCHMARK_DIR, f"ess_{label}.csv"), index=False)
+    if baseline is not None:
+        print(f"Ratios to the {baseline} results:")
+        for results, name, key, columns in [
+            (stages, "stages", STAGE_KEY, ["seconds", "peak_rss_mb"]),
+            (ess, "ess", ESS_KEY, ["ess_bulk_per_second", "ess_tail_per_second"]),
+        ]:
+            baseline_file = os.path.join(BENCHMARK_DIR, f"{name}_{baseline}.csv")
+            print(compare_to_baseline(results, baseline_file, key, columns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages.")
+    parser.add_argument("--label", default="current", help="Name for the results.")
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="Label of earlier results to compare the new results with.",
+    )
+    args = parser.parse_args()
+    main(args.label, args.baseline)
@@ -0,0 +1,140 @@
+"""Exact grouped K-fold or leave-one-replicate-out cross-validation.
+
+Each fold holds out a set of replicates, refits the model to the rest and
+records the elpd of every held-out replicate. Folds run concurrently and each
+fold's results are appended to a csv file as soon as it finishes, so a partial
+run still gives usable results and an interrupted run carries on from the
+folds that are missing.
+
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from scipy.special import logsumexp
+
+from artifacts import get_fingerprint, read_fingerprint, writing
+from fit_models import (LOO_DIR, N_CORES, PRIORS, RAW_DATA_DIR, SAMPLES_DIR,
+                        STAN_FILES, TREATMENTS, StanData)
+from munging import load_prepared_data
+from run_reloo_analysis import SAMPLE_CONFIG
+from stan_models import (build_models, get_model, get_model_hash,
+                         write_stan_json)
+
+CV_COLUMNS = ["fold", "replicate", "elpd"]
+
+
+def get_folds(n_replicates, n_folds=None, seed=SAMPLE_CONFIG["seed"]):
+    """Randomly assign replicates to folds.
+
+    With n_folds=None every replicate gets its own fold, i.e. the result is
+    leave-one-replicate-out cross-validation.
+
+    """
+    replicates = np.arange(1, n_replicates + 1)
+    if n_folds is None:
+        return [[int(r)] for r in replicates]
+    shuffled = np.random.default_rng(seed).permutation(replicates)
+    return [sorted(fold.tolist()) for fold in np.array_split(shuffled, n_folds)]
+
+
+def write_fold_input(stan_input, output_dir):
+    """Write a fold's stan input to output_dir, returning the file's path."""
+    os.makedirs(output_dir, exist_ok=True)
+    json_file = os.path.join(output_dir, "input_data.json")
+    write_stan_json(json_file, stan_input)
+    return json_file
+
+
+def fit_fold(stan_file, data, sample_kwargs, test_replicates):
+    """Fit a model to one fold's training data.
+
+    Returns the elpd of each test replicate.
+
+    """
+    mcmc = get_model(stan_file).sample(data=data, **sample_kwargs)
+    llik = np.asarray(mcmc.stan_variable("llik"))[:, np.array(test_replicates) - 1]
+    return logsumexp(llik, axis=0) - np.log(len(llik))
+
+
+def run_cv(treatment_label, model_name, xname, n_folds=None, n_cores=N_CORES):
+    """Cross-validate one run, streaming per-fold elpd to a csv file."""
+    stan_file = STAN_FILES[model_name]
+    design_col = "design_" + xname
+    run_name = f"{treatment_label}_{model_name}_{xname}"
+    cv_name = f"cv_{n_folds}fold" if n_folds is not None else "cv_loro"
+    cv_file = os.path.join(LOO_DIR, f"{cv_name}_{run_name}.csv")
+    msmts = load_prepared_data(RAW_DATA_DIR, TREATMENTS[treatment_label])
+    replicate_names = msmts.groupby("replicate_fct")["replicate"].first()
+    stan_data = StanData(msmts, design_col)
+    stan_input = stan_data.get_input(PRIORS)
+    folds = get_folds(stan_input["R"], n_folds)
+    fingerprint = get_fingerprint(
+        stan_input, get_model_hash(stan_file), SAMPLE_CONFIG, folds
+    )
+    if read_fingerprint(cv_file) == fingerprint:
+        done = set(pd.read_csv(cv_file)["fold"])
+    else:
+        with writing(cv_file, fingerprint):
+            pd.DataFrame(columns=CV_COLUMNS).to_csv(cv_file, index=False)
+        done = set()
+    todo = [i for i in range(len(folds)) if i not in done]
+    print(f"Cross-validating {run_name}: {len(todo)} of {len(folds)} folds to do.")
+    n_workers = max(n_cores // SAMPLE_CONFIG["chains"], 1)
+    build_models([stan_file])  # so that workers only read the model cache
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(
+                fit_fold,
+                stan_file,
+                write_fold_input(
+                    stan_data.get_input(PRIORS, test_replicates=folds[i]),
+                    os.path.join(SAMPLES_DIR, cv_name, run_name, f"fold_{i}"),
+                ),
+                {
+                    **SAMPLE_CONFIG,
+                    "seed": SAMPLE_CONFIG["seed"] + i + 1,
+                    "output_dir": os.path.join(
+                        SAMPLES_DIR, cv_name, run_name, f"fold_{i}"
+                    ),
+                },
+                folds[i],
+            ): i
+            for i in todo
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            fold_result = pd.DataFrame(
+                {
+                    "fold": i,
+                    "replicate": replicate_names.loc[folds[i]].values,
+                    "elpd": future.result(),
+                }
+            )
+            fold_result.to_csv(cv_file, mode="a", header=False, index=False)
+            print(f"Finished fold {i} of {run_name}.")
+    result = pd.read_csv(cv_file)
+    elpd = result["elpd"].sum()
+    se = np.sqrt(len(result) * result["elpd"].var(ddof=0))
+    print(f"{cv_name} elpd for {run_name}: {elpd:.2f} (se {se:.2f})")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-validate a model.")
+    parser.add_argument("treatment", choices=list(TREATMENTS.keys()))
+    parser.add_argument("model", choices=list(STAN_FILES.keys()))
+    parser.add_argument("xname", choices=["ab", "abc", "null"])
+    parser.add_argument(
+        "--folds",
+        type=int,
+        default=None,
+        help="Number of folds. Default: one fold per replicate.",
+    )
+    parser.add_argument(
+        "--cores", type=int, default=N_CORES, help="Number of cores to use."
+    )
+    args = parser.parse_args()
+    run_cv(args.treatment, args.model, args.xname, args.folds, args.cores)
@@ -1,4 +1,14 @@
+"""Draw every figure, in parallel, skipping figures whose inputs are unchanged.
+
+main builds a job for each figure, keyed by its output file so that figures
+shared by several runs are only drawn once. Each job records the fingerprint
+of the figure's inputs, and jobs whose files are already up to date are
+dropped. The rest are drawn in a process pool.
+
+"""
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import arviz as az
 import numpy as np
@@ -6,12 +16,19 @@ import pandas as pd
 from matplotlib import pyplot as plt
 from matplotlib.cm import tab20 as cm
 
-from fit_models import (CSV_FILE, INFD_DIR, LOO_DIR, MODEL_SETS,
-                        TREATMENT_TO_MODEL_SET, TREATMENTS)
-from munging import prepare_data
+from artifacts import (get_file_hash, get_fingerprint, is_fresh,
+                       read_fingerprint, writing)
+from fit_models import (INFD_DIR, LOO_DIR, N_CORES, RAW_DATA_DIR, TREATMENTS,
+                        get_comparison_name, get_runs, get_screen_file)
+from generate_quantities import run_gq
+from munging import load_prepared_data, update_prepared_data
+from stream_netcdf import open_infd
 
 MPL_STYLE = "sparse.mplstyle"
 PLOT_DIR = os.path.join("results", "plots")
+PLOT_CODE_HASH = get_fingerprint(get_file_hash(__file__), get_file_hash(MPL_STYLE))
+PNG_DPI = 150
+TIMECOURSE_QUANTILES = [0.005, 0.995]
 
 
 def plot_design_qs(infd):
@@ -52,34 +69,47 @@ def plot_design_qs(infd):
     return f, axes
 
 
-def plot_timecourses(msmts, infd, run_name):
+def get_timecourse_bands(msmts, posterior, quantiles=TIMECOURSE_QUANTILES):
+    """Get each replicate's posterior predictive band.
+
+    The quantiles of yhat over all draws are computed for each observation at
+    once, directly on the (chain, draw, observation) array, and the quantiles
+    of R0 give each replicate's band at day 0. Returns a dataframe with
+    columns replicate, day, low and high.
+
+    """
+    yhat = posterior["yhat"].values.reshape(-1, len(msmts))
+    R0 = posterior["R0"].values.reshape(-1, posterior["R0"].shape[-1])
+    yhat_qs = np.quantile(yhat, quantiles, axis=0)
+    R0_qs = np.quantile(R0, quantiles, axis=0)
+    return pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "replicate": posterior["R0"].coords["replicate"].values,
+                    "day": 0.0,
+                    "low": R0_qs[0],
+                    "high": R0_qs[1],
+                }
+            ),
+            pd.DataFrame(
+                {
+                    "replicate": msmts["replicate"].values,
+                    "day": msmts["day"].values,
+                    "low": yhat_qs[0],
+                    "high": yhat_qs[1],
+                }
+            ),
+        ],
+        ignore_index=True,
+    ).sort_values(["replicate", "day"])
+
+
+def plot_timecourses(msmts, bands, run_name):
     y_timecourses = msmts.set_index(["design", "clone", "replicate", "day"])[
         "y"
     ].unstack()
-    yhat_timecourses = (
-        infd.posterior["yhat"]
-        .to_series()
-        .unstack()
-        .reset_index(drop=True)
-        .T.set_index(msmts.index)
-        .join(msmts[["design", "clone", "replicate", "day"]])
-        .set_index(["design", "clone", "replicate", "day"])
-        .stack()
-        .unstack("day")
-    )
-    R0s = (
-        infd.posterior["R0"]
-        .to_series()
-        .unstack()
-        .reset_index(drop=True)
-        .T.stack()
-        .rename(0)
-    )
-    timecourse_groups = (
-        yhat_timecourses.join(R0s)
-        .sort_index(axis=1)
-        .groupby(["design", "clone", "replicate"])
-    )
+    bands = bands.set_index("replicate")
     clone_to_row = (
         msmts.groupby("clone")[["design"]]
         .first()
@@ -97,14 +127,14 @@ def plot_timecourses(msmts, infd, run_name):
         sharey=True,
         figsize=[20, 10],
     )
-    for (design, clone, replicate), df in timecourse_groups:
+    for (design, clone, replicate), y in y_timecourses.iterrows():
         row = clone_to_row[clone]
         col = design_to_col[design]
         ax = axes[row, col]
-        y = y_timecourses.loc[(design, clone, replicate)]
-        low = df.quantile(0.005)
-        high = df.quantile(0.995)
-        fill = ax.fill_between(df.columns, low, high, alpha=0.2, zorder=0, color="grey")
+        band = bands.loc[replicate]
+        fill = ax.fill_between(
+            band["day"], band["low"], band["high"], alpha=0.2, zorder=0, color="grey"
+        )
         yline = ax.plot(y, color="black", label="Clone " + clone)
         if row == 0:
             ax.set_title(design)
@@ -125,12 +155,10 @@ def plot_timecourses(msmts, infd, run_name):
     return f, axes
 
 
-def main():
-    plt.style.use(MPL_STYLE)
-
-    # null model demonstration
-    infd = az.from_netcdf("results/infd/infd_puromycin_null_null.nc")
-    msmts = prepare_data(pd.read_csv(CSV_FILE), treatment="15ug/mL Puromycin")
+def plot_null_model_demo(infd_file):
+    """Show that clone effects mimic design effects in the null model."""
+    infd = open_infd(infd_file, {"posterior": ["cq", "cd", "ct"]})
+    msmts = load_prepared_data(RAW_DATA_DIR, "15ug/mL Puromycin")
     clone_to_design = msmts.groupby("clone")["design"].first()
     cv_qs = (
         infd.posterior[["cq", "cd", "ct"]]
@@ -161,67 +189,248 @@ def main():
         "Clonal variation effects mimic design effects in the null model "
         + "for Puromycin challenged cells"
     )
-    f.savefig(os.path.join(PLOT_DIR, "null_model_demo.svg"))
+    return f
+
+
+def read_comparison(comparison_file):
+    return (
+        pd.read_csv(comparison_file)
+        .rename(columns={"Unnamed: 0": "index"})
+        .set_index("index")
+    )
+
+
+def plot_comparison(comparison_file, title, xlabel):
+    az.plot_compare(
+        read_comparison(comparison_file), insample_dev=False, plot_ic_diff=False
+    )
+    plt.xlabel(xlabel)
+    plt.title(title)
+    return plt.gcf()
+
+
+def plot_khat(loo_file, title):
+    az.plot_khat(pd.read_pickle(loo_file))
+    plt.title(title)
+    return plt.gcf()
+
+
+def plot_trace(infd_file, var_names, xname):
+    """Plot KDEs and traces, labelling the first few designs if there are any."""
+    infd = open_infd(infd_file, {"posterior": var_names})
+    axes = az.plot_trace(infd, var_names=var_names, combined=True)
+    if xname != "null":
+        kde_axis = axes[0][0]
+        kde_axis.legend(
+            kde_axis.get_lines()[:4], infd.posterior.coords["design"].values[:4]
+        )
+    return plt.gcf()
+
+
+def plot_run_design_qs(infd_file):
+    f, axes = plot_design_qs(open_infd(infd_file, {"posterior": ["dt", "dd", "dq"]}))
+    return f
+
+
+def get_timecourse_infd(treatment_label, model_name, xname):
+    """Get a run's inference data, with yhat from run_gq if it wasn't saved."""
+    run_name = f"{treatment_label}_{model_name}_{xname}"
+    infd = open_infd(
+        os.path.join(INFD_DIR, f"infd_{run_name}.nc"), {"posterior": ["yhat", "R0"]}
+    )
+    if "yhat" in infd.posterior:
+        return infd
+    gq_posterior = run_gq(treatment_label, model_name, xname).posterior
+    return az.InferenceData(
+        posterior=infd.posterior.sel(draw=gq_posterior["draw"]).assign(
+            yhat=gq_posterior["yhat"]
+        )
+    )
+
+
+def get_bands_file(run_name):
+    return os.path.join(INFD_DIR, f"timecourse_bands_{run_name}.csv")
+
+
+def get_bands_fingerprint(run_name):
+    return get_fingerprint(
+        read_fingerprint(os.path.join(INFD_DIR, f"infd_{run_name}.nc")),
+        TIMECOURSE_QUANTILES,
+        PLOT_CODE_HASH,
+    )
+
+
+def plot_run_timecourses(treatment_label, model_name, xname):
+    """Plot a run's timecourses, with predictive bands cached on disk.
+
+    The bands are only recomputed if the run's inference data have changed.
+
+    """
+    run_name = f"{treatment_label}_{model_name}_{xname}"
+    msmts = load_prepared_data(RAW_DATA_DIR, TREATMENTS[treatment_label])
+    bands_file = get_bands_file(run_name)
+    bands_fingerprint = get_bands_fingerprint(run_name)
+    if is_fresh(bands_file, bands_fingerprint):
+        bands = pd.read_csv(bands_file)
+    else:
+        infd = get_timecourse_infd(treatment_label, model_name, xname)
+        bands = get_timecourse_bands(msmts, infd.posterior)
+        with writing(bands_file, bands_fingerprint):
+            bands.to_csv(bands_file, index=False)
+    f, axes = plot_timecourses(msmts, bands, run_name)
+    return f
+
+
+def draw_figure(plot_stem, plot_function, args, fingerprint, formats):
+    """Draw one figure and save it as plot_stem.<format> for each format."""
+    plt.style.use(MPL_STYLE)
+    f = plot_function(*args)
+    for fmt in formats:
+        with writing(f"{plot_stem}.{fmt}", fingerprint) as path:
+            f.savefig(path, bbox_inches="tight", dpi=PNG_DPI if fmt == "png" else None)
+    plt.close("all")
+    return plot_stem
+
+
+def get_jobs(reparameterised=False):
+    """Get a job for every figure whose inputs exist.
+
+    Returns a dictionary mapping each figure's path, without an extension, to
+    the function that draws it, the function's arguments and the fingerprint
+    of the figure's inputs. If reparameterised is True, the runs and
+    comparisons are those of the reparameterised models.
+
+    """
+    jobs = {}
+
+    def add_job(plot_name, plot_function, args, *inputs):
+        jobs[os.path.join(PLOT_DIR, plot_name)] = (
+            plot_function,
+            args,
+            get_fingerprint(*inputs, PLOT_CODE_HASH),
+        )
 
+    null_infd_file = os.path.join(INFD_DIR, "infd_puromycin_null_null.nc")
+    if os.path.exists(null_infd_file):
+        add_job(
+            "null_model_demo",
+            plot_null_model_demo,
+            (null_infd_file,),
+            read_fingerprint(null_infd_file),
+        )
     for treatment_label, treatment in TREATMENTS.items():
-        for model_name, xname in MODEL_SETS[TREATMENT_TO_MODEL_SET[treatment_label]]:
-            run_name = f"{treatment_label}_{model_name}_{xname}"
-            print(f"Drawing plots for model {run_name}")
-            msmts = prepare_data(pd.read_csv(CSV_FILE), treatment=treatment)
-            comparison = (
-                pd.read_csv(
-                    os.path.join(LOO_DIR, f"reloo_comparison_{treatment_label}.csv")
-                )
-                .rename(columns={"Unnamed: 0": "index"})
-                .set_index("index")
+        comparison_name = get_comparison_name(treatment_label, reparameterised)
+        screen_file = get_screen_file(treatment_label, reparameterised)
+        if os.path.exists(screen_file):
+            screen_hash = get_file_hash(screen_file)
+            add_job(
+                f"screen_comparison_{comparison_name}",
+                plot_comparison,
+                (screen_file, comparison_name, "Approximate LOO Score (ADVI)"),
+                screen_hash,
             )
+            for run_name in read_comparison(screen_file).index:
+                add_job(
+                    f"screen_khat_{run_name}",
+                    plot_khat,
+                    (
+                        os.path.join(LOO_DIR, f"screen_loo_{run_name}.pkl"),
+                        f"Pareto k of approximate loo: {run_name}",
+                    ),
+                    screen_hash,
+                )
+        comparison_file = os.path.join(
+            LOO_DIR, f"reloo_comparison_{comparison_name}.csv"
+        )
+        for model_name, xname in get_runs(treatment_label, reparameterised):
+            run_name = f"{treatment_label}_{model_name}_{xname}"
             infd_file = os.path.join(INFD_DIR, f"infd_{run_name}.nc")
-            infd = az.from_netcdf(infd_file)
-            ## Effects
-            if xname != "null":
-                f, axes = plot_design_qs(infd)
-                f.savefig(
-                    os.path.join(PLOT_DIR, f"design_param_qs_{run_name}.svg"),
-                    bbox_inches="tight",
+            if not os.path.exists(infd_file):
+                print(f"Model {run_name} has not been fitted, not drawing plots.")
+                continue
+            infd_fingerprint = read_fingerprint(infd_file)
+            if os.path.exists(comparison_file):
+                add_job(
+                    f"model_RELOO_comparison_{comparison_name}",
+                    plot_comparison,
+                    (comparison_file, comparison_name, "LOO Score"),
+                    read_fingerprint(comparison_file),
                 )
-            ## Measurement and simulated timecourse profiles
-            f, axes = plot_timecourses(msmts, infd, run_name)
-            f.savefig(
-                os.path.join(PLOT_DIR, f"timecourses_{run_name}.svg"),
-                bbox_inches="tight",
+            add_job(
+                f"timecourses_{run_name}",
+                plot_run_timecourses,
+                (treatment_label, model_name, xname),
+                infd_fingerprint,
             )
-            ## LOO (reloo) scores
-            az.plot_compare(comparison, insample_dev=False, plot_ic_diff=False)
-            plt.xlabel("LOO Score")
-            plt.title(f"{treatment_label}")
-            plt.savefig(
-                os.path.join(PLOT_DIR, f"model_RELOO_comparison_{treatment_label}.svg"),
-                bbox_inches="tight",
+            add_job(
+                f"sampled_params_{run_name}",
+                plot_trace,
+                (infd_file, ["avg_delay"], xname),
+                infd_fingerprint,
             )
-            ## KDE and trace of average delay to death
-            axes = az.plot_trace(infd, var_names=["avg_delay"], combined=True)
             if xname != "null":
-                kde_axis = axes[0][0]
-                kde_axis.legend(
-                    kde_axis.get_lines()[:4], infd.posterior.coords["design"].values[:4]
+                add_job(
+                    f"design_param_qs_{run_name}",
+                    plot_run_design_qs,
+                    (infd_file,),
+                    infd_fingerprint,
                 )
-            plt.savefig(
-                os.path.join(PLOT_DIR, f"sampled_params_{run_name}.svg"),
-                bbox_inches="tight",
-            )
-            ## KDE and trace of sampled values
-            if xname != "null":
-                axes = az.plot_trace(infd, var_names=["tauD", "k_d"], combined=True)
-                kde_axis = axes[0][0]
-                kde_axis.legend(
-                    kde_axis.get_lines()[:4], infd.posterior.coords["design"].values[:4]
+                add_job(
+                    f"sampled_params_posterior_{run_name}",
+                    plot_trace,
+                    (infd_file, ["tauD", "k_d"], xname),
+                    infd_fingerprint,
                 )
-                plt.savefig(
-                    os.path.join(PLOT_DIR, f"sampled_params_posterior_{run_name}.svg"),
-                    bbox_inches="tight"
-                    )
-            plt.close("all")
+    return jobs
+
+
+def main(n_cores=N_CORES, png=False, reparameterised=False):
+    """Draw every figure that is out of date, optionally also as png files.
+
+    If reparameterised is True, the reparameterised models' figures are drawn.
+
+    Generated quantities that the timecourse plots need for new predictive
+    bands are computed first, as run_gq uses several cores itself. The data
+    are prepared up front too, so that workers only read the prepared data
+    cache.
+
+    """
+    update_prepared_data(RAW_DATA_DIR)
+    formats = ["svg", "png"] if png else ["svg"]
+    jobs = {
+        plot_stem: job
+        for plot_stem, job in get_jobs(reparameterised).items()
+        if not all(is_fresh(f"{plot_stem}.{fmt}", job[2]) for fmt in formats)
+    }
+    print(f"Drawing {len(jobs)} figures.")
+    for plot_function, args, _ in jobs.values():
+        if plot_function is not plot_run_timecourses:
+            continue
+        run_name = "_".join(args)
+        if not is_fresh(get_bands_file(run_name), get_bands_fingerprint(run_name)):
+            get_timecourse_infd(*args)
+    os.makedirs(PLOT_DIR, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=n_cores) as executor:
+        futures = [
+            executor.submit(draw_figure, plot_stem, *job, formats)
+            for plot_stem, job in jobs.items()
+        ]
+        for future in futures:
+            print(f"Drew {future.result()}")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Draw figures.")
+    parser.add_argument(
+        "--cores", type=int, default=N_CORES, help="Number of cores to use."
+    )
+    parser.add_argument(
+        "--png", action="store_true", help="Also save figures as png files."
+    )
+    parser.add_argument(
+        "--reparameterised",
+        action="store_true",
+        help="Draw figures for the reparameterised versions of the models.",
+    )
+    args = parser.parse_args()
+    main(args.cores, args.png, args.reparameterised)
@@ -1,11 +1,20 @@
+import argparse
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 import arviz as az
+import numpy as np
 import pandas as pd
-from cmdstanpy import CmdStanModel
-from cmdstanpy.utils import get_logger, jsondump
+from cmdstanpy.utils import get_logger
 
-from munging import prepare_data
+from artifacts import get_fingerprint, is_fresh, writing
+from loo_compare import compare
+from munging import load_prepared_data, update_prepared_data
+from profiling import get_profile_report, timed
+from stan_models import (build_models, get_model, get_model_hash,
+                         write_stan_json)
+from stream_netcdf import get_variable_columns, stream_to_netcdf
 from util import get_99_pct_params_ln
 
 PRIORS = {
@@ -16,7 +25,7 @@ PRIORS = {
     "prior_R0": get_99_pct_params_ln(2, 3),
     "prior_err": get_99_pct_params_ln(0.05, 0.13),
 }
-CSV_FILE = os.path.join("raw_data", "AllFlaskData_compiled.csv")
+RAW_DATA_DIR = os.path.join("raw_data", "runs")
 LIKELIHOOD = 1
 OUTPUT_DIR = "results"
 LOO_DIR = os.path.join(OUTPUT_DIR, "loo")
@@ -34,6 +43,20 @@ SAMPLE_CONFIG = dict(
     adapt_delta=0.99,
     output_dir=SAMPLES_DIR,
 )
+OUTPUT_PROFILES = {
+    "diagnostics-only": dict(save_yhat=0, save_yrep=0, save_llik=0),
+    "loo": dict(save_yhat=0, save_yrep=0, save_llik=1),
+    "full": dict(save_yhat=1, save_yrep=1, save_llik=1),
+}
+OUTPUT_PROFILE = "loo"
+SCREEN_CONFIG = dict(
+    algorithm="meanfield",
+    output_samples=1000,
+    inits=0,
+    seed=12345,
+    require_converged=False,
+)
+SCREEN_DSE_MULTIPLE = 4
 TREATMENTS = {
     "puromycin": "15ug/mL Puromycin",
     "sodium_butyrate": "20mM Sodium Butyrate",
@@ -63,31 +86,130 @@ STAN_FILES = {
     "m2": "m2.stan",
     "m1": "m1.stan",
     "null": "null.stan",
+    "m2_rp": "m2_rp.stan",
+    "m1_rp": "m1_rp.stan",
+    "null_rp": "null_rp.stan",
 }
+REPARAMETERISED_SUFFIX = "_rp"
+DEFAULT_ADAPT_DELTA = 0.8
+REPARAMETERISED_SAMPLE_CONFIG = {**SAMPLE_CONFIG, "adapt_delta": DEFAULT_ADAPT_DELTA}
+N_CORES = os.cpu_count()
+THREADED_CPP_OPTIONS = {"STAN_THREADS": True}
 
 
-def get_stan_input(msmts, priors, design_col):
-    out = {
-        **priors,
-        **{
-            "N": int(len(msmts)),
-            "N_test": int(len(msmts)),
-            "R": int(msmts["replicate"].nunique()),
-            "C": int(msmts["clone"].nunique()),
-            "clone": msmts.groupby("replicate_fct")["clone_fct"].first().values,
-            "replicate": msmts["replicate_fct"].values,
-            "t": msmts["day"].values,
-            "y": msmts["y"].values,
-            "replicate_test": msmts["replicate_fct"].values,
-            "t_test": msmts["day"].values,
-            "y_test": msmts["y"].values,
-            "likelihood": int(LIKELIHOOD),
-        },
-    }
-    if "null" not in design_col:
-        out["design"] = msmts.groupby("clone_fct")[design_col + "_fct"].first().values
-        out["D"] = int(msmts[design_col + "_fct"].max())
-    return out
+def get_sample_config(model_name):
+    """Get a model's sampler configuration.
+
+    The reparameterised models are fitted at the default adapt_delta rather
+    than the original models' 0.99; benchmark_parameterisations.py checks
+    whether that is enough.
+
+    """
+    if model_name.endswith(REPARAMETERISED_SUFFIX):
+        return REPARAMETERISED_SAMPLE_CONFIG
+    return SAMPLE_CONFIG
+
+
+def get_cpp_options(threads_per_chain):
+    """Use a threaded build of the models if chains get more than one thread."""
+    return THREADED_CPP_OPTIONS if threads_per_chain > 1 else None
+
+
+class StanData:
+    """One treatment's data, arranged so that Stan inputs are quick to build.
+
+    The groupby operations are done once, giving each replicate's clone and
+    each clone's design as arrays. row_order sorts the rows by replicate, so
+    the rows of replicate r are row_order[replicate_offsets[r - 1] :
+    replicate_offsets[r]]. Inputs for the full data or for any held-out split
+    are then built by slicing arrays.
+
+    """
+
+    def __init__(self, msmts, design_col):
+        self.design_col = design_col
+        self.t = msmts["day"].values
+        self.y = msmts["y"].values
+        self.replicate = msmts["replicate_fct"].values
+        self.replicate_clone = (
+            msmts.groupby("replicate_fct")["clone_fct"].first().values
+        )
+        self.R = int(msmts["replicate"].nunique())
+        self.C = int(msmts["clone"].nunique())
+        self.row_order = np.argsort(self.replicate, kind="stable")
+        self.replicate_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(self.replicate, minlength=self.R + 1)[1:])]
+        )
+        if "null" not in design_col:
+            self.clone_design = (
+                msmts.groupby("clone_fct")[design_col + "_fct"].first().values
+            )
+            self.D = int(msmts[design_col + "_fct"].max())
+
+    def get_replicate_rows(self, replicates):
+        """Get the rows of some replicates, in their original order."""
+        return np.sort(
+            np.concatenate(
+                [
+                    self.row_order[
+                        self.replicate_offsets[r - 1] : self.replicate_offsets[r]
+                    ]
+                    for r in replicates
+                ]
+            )
+        )
+
+    def get_input(self, priors, output_profile=OUTPUT_PROFILE, test_replicates=None):
+        """Get a stan input, with test_replicates out-of-sample if given.
+
+        test_replicates are values of the column replicate_fct.
+
+        """
+        if test_replicates is None:
+            train = test = slice(None)
+        else:
+            test = self.get_replicate_rows(test_replicates)
+            train = np.delete(np.arange(len(self.y)), test)
+        out = {
+            **priors,
+            **{
+                "N": len(self.y[train]),
+                "N_test": len(self.y[test]),
+                "R": self.R,
+                "C": self.C,
+                "clone": self.replicate_clone,
+                "replicate": self.replicate[train],
+                "t": self.t[train],
+                "y": self.y[train],
+                "replicate_test": self.replicate[test],
+                "t_test": self.t[test],
+                "y_test": self.y[test],
+                "likelihood": int(LIKELIHOOD),
+            },
+            **OUTPUT_PROFILES[output_profile],
+        }
+        if "null" not in self.design_col:
+            out["design"] = self.clone_design
+            out["D"] = self.D
+        return out
+
+
+def get_stan_input(msmts, priors, design_col, output_profile=OUTPUT_PROFILE):
+    return StanData(msmts, design_col).get_input(priors, output_profile)
+
+
+def get_split_stan_input(
+    msmts, priors, design_col, test_replicates, output_profile=OUTPUT_PROFILE
+):
+    """Get a stan input where some replicates are out-of-sample.
+
+    test_replicates are values of the column replicate_fct. To make many
+    splits of the same data, use StanData.get_input instead.
+
+    """
+    return StanData(msmts, design_col).get_input(
+        priors, output_profile, test_replicates
+    )
 
 
 def get_infd_kwargs(msmts, design_col, stan_input):
@@ -111,8 +233,8 @@ def get_infd_kwargs(msmts, design_col, stan_input):
         dims["dd"] = ["design"]
         dims["dt"] = ["design"]
     return dict(
-        log_likelihood="llik",
-        posterior_predictive="yrep",
+        log_likelihood="llik" if stan_input["save_llik"] else None,
+        posterior_predictive="yrep" if stan_input["save_yrep"] else None,
         coords=coords,
         dims=dims,
         observed_data={"y": stan_input["y"]},
@@ -120,59 +242,383 @@ def get_infd_kwargs(msmts, design_col, stan_input):
     )
 
 
-def main():
+def get_variational_infd(vb, coords, dims, observed_data):
+    """Put the draws from a variational fit in an InferenceData.
+
+    The draws are treated as a single chain. If CmdStan reports the log
+    density of each draw under the model (log_p__) and the approximation
+    (log_g__), the pareto k of the resulting importance ratios is saved as
+    the sample stat vb_khat: values above 0.7 mean the approximation is poor.
+
+    """
+    draws = pd.DataFrame(vb.variational_sample.values, columns=vb.column_names)
+    posterior = {
+        name: draws.values[:, cols].reshape([1, len(draws), *shape], order="F")
+        for name, (cols, shape) in get_variable_columns(vb.column_names).items()
+        if not name.endswith("__")
+    }
+    sample_stats = {}
+    if "log_p__" in draws.columns and "log_g__" in draws.columns:
+        log_ratios = (draws["log_p__"] - draws["log_g__"]).values
+        _, khat = az.psislw(log_ratios)
+        sample_stats["vb_khat"] = np.full([1, len(draws)], khat)
+    return az.from_dict(
+        posterior=posterior,
+        log_likelihood={"llik": posterior.pop("llik")},
+        posterior_predictive=(
+            {"yrep": posterior.pop("yrep")} if "yrep" in posterior else None
+        ),
+        sample_stats=sample_stats or None,
+        observed_data=observed_data,
+        coords=coords,
+        dims=dims,
+    )
+
+
+def get_comparison_name(treatment_label, reparameterised=False):
+    """Name a treatment's comparisons, keeping the two parameterisations apart."""
+    return treatment_label + (REPARAMETERISED_SUFFIX if reparameterised else "")
+
+
+def get_screen_file(treatment_label, reparameterised=False):
+    comparison_name = get_comparison_name(treatment_label, reparameterised)
+    return os.path.join(LOO_DIR, f"screen_comparison_{comparison_name}.csv")
+
+
+def get_model_set(treatment_label, reparameterised=False):
+    """Get a treatment's models and designs.
+
+    With reparameterised=True the reparameterised models are used instead.
+
+    """
+    model_set = MODEL_SETS[TREATMENT_TO_MODEL_SET[treatment_label]]
+    if not reparameterised:
+        return model_set
+    return [
+        (model_name + REPARAMETERISED_SUFFIX, xname) for model_name, xname in model_set
+    ]
+
+
+def get_runs(treatment_label, reparameterised=False):
+    """Get a treatment's runs, leaving out any that were screened out.
+
+    If fit_models.py was last run with --screen, the runs that the screen
+    comparison found not to be competitive are left out, so that later steps
+    don't use any outputs left from earlier fits of those runs.
+
+    """
+    model_set = get_model_set(treatment_label, reparameterised)
+    screen_file = get_screen_file(treatment_label, reparameterised)
+    if not os.path.exists(screen_file):
+        return model_set
+    competitive = pd.read_csv(screen_file, index_col=0)["competitive"]
+    return [
+        (model_name, xname)
+        for model_name, xname in model_set
+        if competitive.get(f"{treatment_label}_{model_name}_{xname}", True)
+    ]
+
+
+def screen_run(treatment_label, model_name, xname):
+    """Fit one run with ADVI and get approximate psis-loo from its draws.
+
+    Outputs are written next to the full fit's outputs, with names starting
+    with "screen_".
+
+    """
+    logger = get_logger()
+    logger.setLevel(40)
+    stan_file = STAN_FILES[model_name]
+    design_col = "design_" + xname
+    run_name = f"{treatment_label}_{model_name}_{xname}"
+    loo_file = os.path.join(LOO_DIR, f"screen_loo_{run_name}.pkl")
+    infd_file = os.path.join(INFD_DIR, f"screen_infd_{run_name}.nc")
+    msmts = load_prepared_data(RAW_DATA_DIR, TREATMENTS[treatment_label])
+    stan_input = get_stan_input(msmts, PRIORS, design_col)
+    fingerprint = get_fingerprint(
+        stan_input, get_model_hash(stan_file), PRIORS, SCREEN_CONFIG
+    )
+    if all(is_fresh(f, fingerprint) for f in [infd_file, loo_file]):
+        print(f"Inputs unchanged for model {run_name}, not rescreening.")
+        infd = az.from_netcdf(infd_file)
+    else:
+        print(f"Screening model {run_name}...")
+        vb = get_model(stan_file, logger=logger).variational(
+            data=stan_input,
+            output_dir=os.path.join(SAMPLES_DIR, "screen_" + run_name),
+            **SCREEN_CONFIG,
+        )
+        infd_kwargs = get_infd_kwargs(msmts, design_col, stan_input)
+        infd = get_variational_infd(
+            vb, infd_kwargs["coords"], infd_kwargs["dims"], infd_kwargs["observed_data"]
+        )
+        with writing(infd_file, fingerprint):
+            infd.to_netcdf(infd_file)
+        with writing(loo_file, fingerprint):
+            az.loo(infd, pointwise=True).to_pickle(loo_file)
+    vb_khat = (
+        float(infd.sample_stats["vb_khat"].values.flat[0])
+        if "sample_stats" in infd and "vb_khat" in infd.sample_stats
+        else np.nan
+    )
+    return run_name, pd.read_pickle(loo_file), vb_khat
+
+
+def screen(runs, n_cores=N_CORES, reparameterised=False):
+    """Screen some runs, returning only the ones that are still competitive.
+
+    A run is competitive if its approximate elpd is within SCREEN_DSE_MULTIPLE
+    standard errors of the best run for the same treatment. Each treatment's
+    screen comparison is written to a csv file.
+
+    """
+    with ProcessPoolExecutor(max_workers=n_cores) as executor:
+        futures = {
+            treatment_label: [
+                executor.submit(screen_run, treatment_label, model_name, xname)
+                for model_name, xname in model_set
+            ]
+            for treatment_label, model_set in runs.items()
+        }
+        out = {}
+        for treatment_label, treatment_futures in futures.items():
+            results = [future.result() for future in treatment_futures]
+            comparison = compare({run_name: loo for run_name, loo, _ in results})
+            comparison["vb_khat"] = pd.Series(
+                {run_name: vb_khat for run_name, _, vb_khat in results}
+            )
+            comparison["competitive"] = (
+                comparison["d_loo"] <= SCREEN_DSE_MULTIPLE * comparison["dse"]
+            )
+            print(f"Screen comparison for treatment {TREATMENTS[treatment_label]}:")
+            print(comparison)
+            comparison.to_csv(get_screen_file(treatment_label, reparameterised))
+            out[treatment_label] = [
+                (model_name, xname)
+                for model_name, xname in runs[treatment_label]
+                if comparison.loc[
+                    f"{treatment_label}_{model_name}_{xname}", "competitive"
+                ]
+            ]
+    return out
+
+
+def fit_run(
+    treatment_label,
+    model_name,
+    xname,
+    parallel_chains,
+    threads_per_chain=1,
+    output_profile=OUTPUT_PROFILE,
+):
+    """Fit one model to one treatment, writing inference data and psis-loo.
+
+    The fit is skipped if its outputs were made from the same data, Stan
+    source, priors and sampler configuration.
+
+    With threads_per_chain > 1 each chain's likelihood is split over
+    replicates and evaluated on that many threads using reduce_sum.
+
+    output_profile is a key of OUTPUT_PROFILES saying which large generated
+    quantities to save. Psis-loo needs llik, so it is not done with the
+    "diagnostics-only" profile and None is returned instead. The csv files
+    are kept so that anything left out can be generated later by
+    generate_quantities.py.
+
+    The time taken by each stage of the fit and the Stan model's profile are
+    written to profile_<run name>.csv, next to the inference data.
+
+    """
     logger = get_logger()
     logger.setLevel(40)  # only log messages with at-least-error severity
-    for treatment_label, treatment in TREATMENTS.items():
-        infds = {}
-        for model_name, xname in MODEL_SETS[TREATMENT_TO_MODEL_SET[treatment_label]]:
-            stan_file = STAN_FILES[model_name]
-            design_col = "design_" + xname
-            run_name = f"{treatment_label}_{model_name}_{xname}"
-            loo_file = os.path.join(LOO_DIR, f"loo_{run_name}.pkl")
-            infd_file = os.path.join(INFD_DIR, f"infd_{run_name}.nc")
-            json_file = os.path.join(OUTPUT_DIR, f"input_data_{run_name}.json")
-            print(f"Fitting model {run_name}...")
-            model = CmdStanModel(stan_file=stan_file, logger=logger)
-            msmts = prepare_data(pd.read_csv(CSV_FILE), treatment=treatment)
-            stan_input = get_stan_input(msmts, PRIORS, design_col)
-            jsondump(json_file, stan_input)
-            mcmc = model.sample(data=stan_input, **SAMPLE_CONFIG)
-            print(mcmc.diagnose().replace("\n\n", "\n"))
-            infd_kwargs = get_infd_kwargs(msmts, design_col, stan_input)
-            infd = az.from_cmdstanpy(mcmc, **infd_kwargs)
-            print(
-                az.summary(
-                    infd,
-                    var_names=[
-                        "~cq",
-                        "~cd",
-                        "~ct",
-                        "~err",
-                        "~yhat",
-                        "~dq_free",
-                        "~dd_free",
-                        "~dt_free",
-                        "~R0",
-                        "~log_kd",
-                        "~log_td",
-                        "~log_kq",
-                    ],
-                )
+    treatment = TREATMENTS[treatment_label]
+    stan_file = STAN_FILES[model_name]
+    design_col = "design_" + xname
+    run_name = f"{treatment_label}_{model_name}_{xname}"
+    loo_file = os.path.join(LOO_DIR, f"loo_{run_name}.pkl")
+    infd_file = os.path.join(INFD_DIR, f"infd_{run_name}.nc")
+    adapt_file = os.path.join(INFD_DIR, f"adapt_{run_name}.json")
+    profile_file = os.path.join(INFD_DIR, f"profile_{run_name}.csv")
+    json_file = os.path.join(OUTPUT_DIR, f"input_data_{run_name}.json")
+    timings = {}
+    with timed(timings, "prepare_input"):
+        msmts = load_prepared_data(RAW_DATA_DIR, treatment)
+        stan_input = get_stan_input(msmts, PRIORS, design_col, output_profile)
+        write_stan_json(json_file, stan_input)
+    output_dir = os.path.join(SAMPLES_DIR, run_name)
+    outputs = [infd_file, adapt_file] + ([loo_file] if stan_input["save_llik"] else [])
+    cpp_options = get_cpp_options(threads_per_chain)
+    sample_config = get_sample_config(model_name)
+    fingerprint = get_fingerprint(
+        stan_input, get_model_hash(stan_file, cpp_options), PRIORS, sample_config
+    )
+    if all(is_fresh(f, fingerprint) for f in outputs):
+        print(f"Inputs unchanged for model {run_name}, not refitting.")
+        return run_name, pd.read_pickle(loo_file) if loo_file in outputs else None
+    print(f"Fitting model {run_name}...")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    with timed(timings, "compile"):
+        model = get_model(stan_file, cpp_options=cpp_options, logger=logger)
+    with timed(timings, "sample"):
+        mcmc = model.sample(
+            data=json_file,
+            parallel_chains=parallel_chains,
+            threads_per_chain=threads_per_chain,
+            **{**sample_config, "output_dir": output_dir},
+        )
+    with timed(timings, "diagnose"):
+        print(mcmc.diagnose().replace("\n\n", "\n"))
+    infd_kwargs = get_infd_kwargs(msmts, design_col, stan_input)
+    print(f"Writing inference data to {infd_file}")
+    with timed(timings, "inference_data"):
+        with writing(infd_file, fingerprint):
+            stream_to_netcdf(mcmc.runset.csv_files, infd_file, **infd_kwargs)
+        infd = az.from_netcdf(infd_file)
+    with timed(timings, "summary"):
+        print(
+            az.summary(
+                infd,
+                var_names=[
+                    "~cq",
+                    "~cd",
+                    "~ct",
+                    "~err",
+                    "~yhat",
+                    "~dq_free",
+                    "~dd_free",
+                    "~dt_free",
+                    "~R0",
+                    "~log_kd",
+                    "~log_td",
+                    "~log_kq",
+                ],
             )
-            infds[run_name] = infd
+        )
+    with writing(adapt_file, fingerprint):
+        write_stan_json(
+            adapt_file, {"stepsize": mcmc.stepsize, "inv_metric": mcmc.metric}
+        )
+    loo = None
+    if stan_input["save_llik"]:
+        with timed(timings, "loo"):
             loo = az.loo(infd, pointwise=True)
-            print(f"Writing inference data to {infd_file}")
-            infd.to_netcdf(infd_file)
-            print(f"Writing psis-loo results to {loo_file}\n")
+        print(f"Writing psis-loo results to {loo_file}\n")
+        with writing(loo_file, fingerprint):
             loo.to_pickle(loo_file)
-        comparison = az.compare(infds)
-        print(f"Loo comparison for treatment {treatment}:")
-        print(comparison)
-        comparison.to_csv(
-            os.path.join(LOO_DIR, f"loo_comparison_{treatment_label}.csv")
-        )
+    report = get_profile_report(timings, mcmc.runset.csv_files)
+    print(f"Profile of model {run_name}:\n{report}\n")
+    with writing(profile_file, fingerprint):
+        report.to_csv(profile_file)
+    return run_name, loo
+
+
+def main(
+    n_cores=N_CORES,
+    threads_per_chain=1,
+    screen_first=False,
+    output_profile=OUTPUT_PROFILE,
+    reparameterised=False,
+):
+    """Fit every run, keeping threads * chains * concurrent fits within n_cores.
+
+    If screen_first is True, runs are first screened with ADVI and only the
+    competitive ones are fitted with MCMC. Otherwise any earlier screen
+    comparisons are removed, as every run has an up to date fit.
+
+    If reparameterised is True, the reparameterised version of each model is
+    fitted instead, at the default adapt_delta. Their runs and comparisons
+    are named with REPARAMETERISED_SUFFIX, so the original models' results
+    are kept.
+
+    All models are compiled up front so that workers only read the model
+    cache. Runs are independent so they are submitted to a process pool all at
+    once. Each treatment's loo comparison is done as soon as all of its runs
+    have finished. The data are prepared up front too, so that workers only
+    read the prepared data cache.
+
+    """
+    update_prepared_data(RAW_DATA_DIR)
+    runs = {
+        treatment_label: get_model_set(treatment_label, reparameterised)
+        for treatment_label in TREATMENTS.keys()
+    }
+    if screen_first:
+        build_models(list(STAN_FILES.values()))
+        runs = screen(runs, n_cores, reparameterised)
+    else:
+        # every run is fitted, so an earlier screen no longer applies
+        for treatment_label in runs.keys():
+            screen_file = get_screen_file(treatment_label, reparameterised)
+            if os.path.exists(screen_file):
+                os.remove(screen_file)
+    build_models(list(STAN_FILES.values()), get_cpp_options(threads_per_chain))
+    chains = SAMPLE_CONFIG["chains"]
+    parallel_chains = max(min(chains, n_cores // threads_per_chain), 1)
+    n_workers = max(n_cores // (chains * threads_per_chain), 1)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            treatment_label: [
+                executor.submit(
+                    fit_run,
+                    treatment_label,
+                    model_name,
+                    xname,
+                    parallel_chains,
+                    threads_per_chain,
+                    output_profile,
+                )
+                for model_name, xname in model_set
+            ]
+            for treatment_label, model_set in runs.items()
+        }
+        for treatment_label, treatment_futures in futures.items():
+            loos = dict(future.result() for future in treatment_futures)
+            if any(loo is None for loo in loos.values()):
+                continue
+            comparison = compare(loos)
+            print(f"Loo comparison for treatment {TREATMENTS[treatment_label]}:")
+            print(comparison)
+            comparison_name = get_comparison_name(treatment_label, reparameterised)
+            comparison.to_csv(
+                os.path.join(LOO_DIR, f"loo_comparison_{comparison_name}.csv")
+            )
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Fit all models.")
+    parser.add_argument(
+        "--cores",
+        type=int,
+        default=N_CORES,
+        help="Total number of cores to use (chains * concurrent fits <= cores).",
+    )
+    parser.add_argument(
+        "--threads-per-chain",
+        type=int,
+        default=1,
+        help="Threads per chain. More than one uses a threaded build of the models.",
+    )
+    parser.add_argument(
+        "--screen",
+        action="store_true",
+        help="Screen runs with ADVI first and only fit the competitive ones.",
+    )
+    parser.add_argument(
+        "--output-profile",
+        choices=list(OUTPUT_PROFILES.keys()),
+        default=OUTPUT_PROFILE,
+        help="Which large generated quantities to save.",
+    )
+    parser.add_argument(
+        "--reparameterised",
+        action="store_true",
+        help="Fit the reparameterised versions of the models.",
+    )
+    args = parser.parse_args()
+    main(
+        n_cores=args.cores,
+        threads_per_chain=args.threads_per_chain,
+        screen_first=args.screen,
+        output_profile=args.output_profile,
+        reparameterised=args.reparameterised,
+    )
@@ -0,0 +1,252 @@
+"""Generate quantities that a fit's output profile left out.
+
+fit_models.py keeps each fit's csv files in SAMPLES_DIR/<run name>, so the
+generated quantities block can be rerun for the same draws without
+refitting, either with a different output profile or with new test data such
+as a dense grid of time points.
+
+If a fit has more than GQ_DRAWS draws, only an evenly thinned subset of at
+most GQ_DRAWS draws is used. That leaves about ten draws beyond each end of
+the 99% intervals that draw_plots shows. The draw coordinate of the output
+records which of the original draws were kept. Each chain's draws are split
+into pieces of at most PIECE_DRAWS draws which are processed concurrently, so
+all cores are used even when there are fewer chains than cores. The pieces,
+and so the seed each one gets, don't depend on the number of cores, so the
+output is the same on any machine.
+
+"""
+import argparse
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+import arviz as az
+import numpy as np
+from cmdstanpy.utils import get_logger
+
+from artifacts import get_fingerprint, is_fresh, read_fingerprint, writing
+from fit_models import (INFD_DIR, N_CORES, OUTPUT_PROFILES, PRIORS,
+                        RAW_DATA_DIR, SAMPLE_CONFIG, SAMPLES_DIR, STAN_FILES,
+                        TREATMENTS, get_infd_kwargs, get_stan_input)
+from munging import load_prepared_data
+from stan_models import get_model, get_model_hash, write_stan_json
+from stream_netcdf import stream_to_netcdf
+
+GQ_DRAWS = 2000
+PIECE_DRAWS = 50
+GRID_POINTS = 50
+PREDICTION_PROFILE = dict(save_yhat=0, save_yrep=1, save_llik=0)
+CONFIG_REGEX = re.compile(r"^#\s*(num_samples|thin) = ")
+
+
+def get_sample_csv_files(run_name):
+    """Find the csv files from a run's most recent fit."""
+    csv_files = sorted(glob(os.path.join(SAMPLES_DIR, run_name, "*.csv")))
+    if len(csv_files) == 0:
+        raise FileNotFoundError(
+            f"No csv files for run {run_name}: run fit_models.py first."
+        )
+    return csv_files
+
+
+def count_draws(csv_file):
+    with open(csv_file, "r") as f:
+        return sum(1 for line in f if not line.startswith("#") and line.strip()) - 1
+
+
+def write_csv_subset(csv_file, out_file, keep):
+    """Copy a CmdStan csv file, keeping only the draws whose indexes are in keep.
+
+    The num_samples and thin config lines are changed to match the new number
+    of draws, as cmdstanpy checks them.
+
+    """
+    keep = set(keep)
+    with open(csv_file, "r") as f_in, open(out_file, "w") as f_out:
+        i = -1  # the header line comes before the first draw
+        for line in f_in:
+            if line.startswith("#") or not line.strip():
+                match = CONFIG_REGEX.match(line)
+                if match is not None:
+                    value = len(keep) if match.group(1) == "num_samples" else 1
+                    line = f"#     {match.group(1)} = {value}\n"
+                f_out.write(line)
+            else:
+                if i == -1 or i in keep:
+                    f_out.write(line)
+                i += 1
+
+
+def split_csv_files(csv_files, output_dir, n_draws, piece_draws=PIECE_DRAWS):
+    """Thin each chain's csv file and split it into pieces of piece_draws draws.
+
+    Returns a list with the pieces of each chain, in order, and the indexes of
+    the draws that were kept.
+
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    out = []
+    chain_draws = count_draws(csv_files[0])
+    thin = max(-(-chain_draws * len(csv_files) // n_draws), 1)
+    kept = np.arange(0, chain_draws, thin)
+    n_pieces = -(-len(kept) // piece_draws)
+    for chain, csv_file in enumerate(csv_files):
+        pieces = np.array_split(kept, n_pieces)
+        out.append([])
+        for i, keep in enumerate(p for p in pieces if len(p) > 0):
+            piece_file = os.path.join(output_dir, f"chain_{chain}_piece_{i}.csv")
+            write_csv_subset(csv_file, piece_file, keep)
+            out[-1].append(piece_file)
+    return out, kept
+
+
+def generate_pieces(model, data, chain_pieces, output_dir, n_cores):
+    """Run generated quantities for every piece, returning the output files."""
+    with ThreadPoolExecutor(max_workers=n_cores) as executor:
+        futures = [
+            [
+                executor.submit(
+                    model.generate_quantities,
+                    data=data,
+                    mcmc_sample=[piece],
+                    seed=SAMPLE_CONFIG["seed"] + chain * len(pieces) + i,
+                    gq_output_dir=os.path.join(output_dir, f"chain_{chain}_piece_{i}"),
+                )
+                for i, piece in enumerate(pieces)
+            ]
+            for chain, pieces in enumerate(chain_pieces)
+        ]
+        return [
+            [future.result().runset.csv_files[0] for future in chain_futures]
+            for chain_futures in futures
+        ]
+
+
+def get_grid_stan_input(msmts, priors, design_col, n_grid=GRID_POINTS):
+    """Get a stan input whose test observations are a dense grid of times.
+
+    Each replicate gets n_grid evenly spaced time points, from zero to the
+    last day on which it was measured.
+
+    """
+    out = get_stan_input(msmts, priors, design_col)
+    last_day = msmts.groupby("replicate_fct")["day"].max()
+    t_test = np.concatenate([np.linspace(0, d, n_grid) for d in last_day.values])
+    out["t_test"] = t_test
+    out["replicate_test"] = np.repeat(last_day.index.values, n_grid)
+    out["y_test"] = np.ones(len(t_test))  # unused as llik is not saved
+    out["N_test"] = len(t_test)
+    out.update(PREDICTION_PROFILE)
+    return out
+
+
+def run_gq(
+    treatment_label,
+    model_name,
+    xname,
+    output_profile="full",
+    n_grid=None,
+    n_draws=GQ_DRAWS,
+    n_cores=N_CORES,
+):
+    """Get generated quantities for a run, computing them if necessary.
+
+    With n_grid=None the generated quantities are computed for the run's own
+    data with the given output profile and written to gq_<run name>.nc.
+    Otherwise posterior predictive draws are made for a grid of n_grid time
+    points per replicate and written to gq_grid_<run name>.nc, in the
+    predictions group, next to the grid in the predictions_constant_data
+    group.
+
+    """
+    logger = get_logger()
+    logger.setLevel(40)
+    stan_file = STAN_FILES[model_name]
+    design_col = "design_" + xname
+    run_name = f"{treatment_label}_{model_name}_{xname}"
+    gq_name = "gq" if n_grid is None else "gq_grid"
+    infd_file = os.path.join(INFD_DIR, f"infd_{run_name}.nc")
+    gq_file = os.path.join(INFD_DIR, f"{gq_name}_{run_name}.nc")
+    output_dir = os.path.join(SAMPLES_DIR, gq_name, run_name)
+    msmts = load_prepared_data(RAW_DATA_DIR, TREATMENTS[treatment_label])
+    if n_grid is None:
+        stan_input = get_stan_input(msmts, PRIORS, design_col, output_profile)
+    else:
+        stan_input = get_grid_stan_input(msmts, PRIORS, design_col, n_grid)
+    fingerprint = get_fingerprint(
+        read_fingerprint(infd_file),
+        stan_input,
+        get_model_hash(stan_file),
+        n_draws,
+        PIECE_DRAWS,
+    )
+    if is_fresh(gq_file, fingerprint):
+        return az.from_netcdf(gq_file)
+    print(f"Generating quantities for model {run_name}...")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    json_file = os.path.join(output_dir, "input_data.json")
+    write_stan_json(json_file, stan_input)
+    csv_files = get_sample_csv_files(run_name)
+    chain_pieces, kept = split_csv_files(
+        csv_files, os.path.join(output_dir, "draws"), n_draws
+    )
+    gq_files = generate_pieces(
+        get_model(stan_file, logger=logger),
+        json_file,
+        chain_pieces,
+        output_dir,
+        n_cores,
+    )
+    infd_kwargs = get_infd_kwargs(msmts, design_col, stan_input)
+    if n_grid is not None:
+        replicates = infd_kwargs["coords"]["replicate"]
+        infd_kwargs["posterior_predictive"] = None
+        infd_kwargs["predictions"] = "yrep"
+        infd_kwargs["dims"].update(
+            yrep=["time_point"], t_test=["time_point"], replicate_test=["time_point"]
+        )
+        infd_kwargs["predictions_constant_data"] = {
+            "t_test": stan_input["t_test"],
+            "replicate_test": replicates.loc[stan_input["replicate_test"]].values,
+        }
+    with writing(gq_file, fingerprint):
+        stream_to_netcdf(gq_files, gq_file, draw_index=kept, **infd_kwargs)
+    return az.from_netcdf(gq_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rerun generated quantities.")
+    parser.add_argument("treatment", choices=list(TREATMENTS.keys()))
+    parser.add_argument("model", choices=list(STAN_FILES.keys()))
+    parser.add_argument("xname", choices=["ab", "abc", "null"])
+    parser.add_argument(
+        "--output-profile",
+        choices=list(OUTPUT_PROFILES.keys()),
+        default="full",
+        help="Which generated quantities to save.",
+    )
+    parser.add_argument(
+        "--grid",
+        type=int,
+        default=None,
+        help="Predict at this many evenly spaced time points per replicate.",
+    )
+    parser.add_argument(
+        "--draws", type=int, default=GQ_DRAWS, help="Number of draws to use."
+    )
+    parser.add_argument(
+        "--cores", type=int, default=N_CORES, help="Number of cores to use."
+    )
+    args = parser.parse_args()
+    run_gq(
+        args.treatment,
+        args.model,
+        args.xname,
+        output_profile=args.output_profile,
+        n_grid=args.grid,
+        n_draws=args.draws,
+        n_cores=args.cores,
+    )
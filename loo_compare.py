@@ -1,10 +1,96 @@
+from concurrent.futures import ProcessPoolExecutor
+
 from scipy.optimize import minimize
+from scipy.special import softmax
 import numpy as np
 from arviz.stats.stats import _ic_matrix
 import pandas as pd
 
+BOOTSTRAP_SEED = 12345
+
+
+def stacking_weights(ic_i_val, obs_weights=None):
+    """Find the stacking weights for a matrix of pointwise elpds.
+
+    ic_i_val has one row per observation and one column per model. Each row is
+    shifted by its maximum before exponentiating, which doesn't change the
+    optimal weights but stops very negative elpds from underflowing to zero.
+    If obs_weights is given, each observation's contribution to the objective
+    is multiplied by its weight.
+
+    The weights are the softmax of unconstrained parameters, which are found
+    with L-BFGS-B. The objective and its gradient each take two matrix-vector
+    products, so this stays fast with hundreds of models.
+
+    """
+    rows, cols = ic_i_val.shape
+    if cols == 1:
+        return np.ones(1)
+    if obs_weights is None:
+        obs_weights = np.ones(rows)
+    exp_ic_i = np.exp(ic_i_val - ic_i_val.max(axis=1, keepdims=True))
+
+    def log_score_and_gradient(z):
+        weights = softmax(z)
+        mix = exp_ic_i @ weights
+        return (
+            -obs_weights @ np.log(mix),
+            weights * (obs_weights.sum() - exp_ic_i.T @ (obs_weights / mix)),
+        )
+
+    result = minimize(
+        log_score_and_gradient, np.zeros(cols), jac=True, method="L-BFGS-B"
+    )
+    return softmax(result["x"])
+
+
+def get_bootstrap_obs_weights(rows, n_draws, seed=BOOTSTRAP_SEED):
+    """Get Bayesian bootstrap weights, one row of observation weights per draw.
+
+    The weights are scaled to sum to the number of observations, so a draw's
+    weighted sum of pointwise elpds is on the same scale as the total elpd.
+
+    """
+    rng = np.random.default_rng(seed)
+    return rows * rng.dirichlet(np.ones(rows), size=n_draws)
+
+
+def pseudo_bma_plus_weights(ic_i_val, n_draws=1000, seed=BOOTSTRAP_SEED):
+    """Find pseudo-BMA+ weights for a matrix of pointwise elpds.
+
+    These are pseudo-BMA weights, i.e. the softmax of each model's total elpd,
+    averaged over Bayesian bootstrap draws of the observations. All draws are
+    done at once with one matrix product.
+
+    """
+    obs_weights = get_bootstrap_obs_weights(ic_i_val.shape[0], n_draws, seed)
+    return softmax(obs_weights @ ic_i_val, axis=1).mean(axis=0)
+
+
+def _stacking_weights_batch(ic_i_val, obs_weights_batch):
+    return np.array([stacking_weights(ic_i_val, w) for w in obs_weights_batch])
+
 
-def compare(elpd_data_dict):
+def bootstrap_stacking_weights(ic_i_val, n_draws=1000, n_cores=1, seed=BOOTSTRAP_SEED):
+    """Find stacking weights for Bayesian bootstrap draws of the observations.
+
+    The draws are split into one batch per core and each batch is processed
+    by a separate worker. Returns an array with one row of weights per draw.
+
+    """
+    obs_weights = get_bootstrap_obs_weights(ic_i_val.shape[0], n_draws, seed)
+    if n_cores == 1:
+        return _stacking_weights_batch(ic_i_val, obs_weights)
+    batches = np.array_split(obs_weights, n_cores)
+    with ProcessPoolExecutor(max_workers=n_cores) as executor:
+        futures = [
+            executor.submit(_stacking_weights_batch, ic_i_val, batch)
+            for batch in batches
+        ]
+        return np.concatenate([future.result() for future in futures])
+
+
+def compare(elpd_data_dict, n_bootstrap=0, n_cores=1):
     r"""Compare models based on PSIS-LOO `loo` or WAIC `waic` cross-validation.
     LOO is leave-one-out (PSIS-LOO `loo`) cross-validation and
     WAIC is the widely applicable information criterion.
@@ -14,6 +100,12 @@ def compare(elpd_data_dict):
     ----------
     elpd_data_dict: dict[str] -> InferenceData
         A dictionary of model names and ELPDData objects
+    n_bootstrap: int
+        Number of Bayesian bootstrap draws used for the pseudo-BMA+ weights and
+        the bootstrap distribution of the stacking weights. If 0 (the default)
+        these are not computed.
+    n_cores: int
+        Number of processes used for the bootstrap stacking weights.
     Returns
     -------
     A DataFrame, ordered from best to worst model (measured by information criteria).
@@ -39,6 +131,10 @@ def compare(elpd_data_dict):
         This could be indication of WAIC/LOO starting to fail see
         http://arxiv.org/abs/1507.04544 for details.
     scale: Scale used for the IC.
+    pbma_plus_weight: Pseudo-BMA+ weight. Only if n_bootstrap > 0.
+    boot_weight_mean, boot_weight_low, boot_weight_high: Mean, 2.5% and 97.5%
+        quantiles of the stacking weights over Bayesian bootstrap draws of the
+        observations. Only if n_bootstrap > 0.
     Examples
     --------
     Compare the centered and non centered models of the eight school problem:
@@ -57,24 +153,6 @@ def compare(elpd_data_dict):
     loo : Compute the Pareto Smoothed importance sampling Leave One Out cross-validation.
     waic : Compute the widely applicable information criterion.
     """
-    def w_fuller(weights):
-        return np.concatenate((weights, [max(1.0 - np.sum(weights), 0.0)]))
-
-    def log_score(weights):
-        w_full = w_fuller(weights)
-        score = 0.0
-        for i in range(rows):
-            score += np.log(np.dot(exp_ic_i[i], w_full))
-        return -score
-
-    def gradient(weights):
-        w_full = w_fuller(weights)
-        grad = np.zeros(km1)
-        for k in range(km1):
-            for i in range(rows):
-                grad[k] += (exp_ic_i[i, k] - exp_ic_i[i, km1]) / np.dot(exp_ic_i[i], w_full)
-        return -grad
-
     ic = "loo"
     names = list(elpd_data_dict.keys())
     scale = "log"
@@ -101,18 +179,7 @@ def compare(elpd_data_dict):
         .assign(loo_i=lambda df: df["loo_i"].apply(lambda x: x.values.flatten()))
     )
     rows, cols, ic_i_val = _ic_matrix(ics, "loo_i")
-    exp_ic_i = np.exp(ic_i_val / scale_value)
-    km1 = cols - 1
-    theta = np.full(km1, 1.0 / cols)
-    bounds = [(0.0, 1.0) for _ in range(km1)]
-    constraints = [
-        {"type": "ineq", "fun": lambda x: -np.sum(x) + 1.0},
-        {"type": "ineq", "fun": np.sum},
-    ]
-    weights = minimize(
-        fun=log_score, x0=theta, jac=gradient, bounds=bounds, constraints=constraints
-    )
-    weights = w_fuller(weights["x"])
+    weights = stacking_weights(ic_i_val / scale_value)
     ses = ics["loo_se"]
     if np.any(weights):
         min_ic_i_val = ics["loo_i"].iloc[0]
@@ -139,4 +206,16 @@ def compare(elpd_data_dict):
             )
     df_comp["rank"] = df_comp["rank"].astype(int)
     df_comp["warning"] = df_comp["warning"].astype(bool)
+    if n_bootstrap > 0:
+        elpd_i_val = ic_i_val / scale_value
+        boot_weights = pd.DataFrame(
+            bootstrap_stacking_weights(elpd_i_val, n_bootstrap, n_cores),
+            columns=ics.index,
+        )
+        df_comp["pbma_plus_weight"] = pd.Series(
+            pseudo_bma_plus_weights(elpd_i_val, n_bootstrap), index=ics.index
+        )
+        df_comp["boot_weight_mean"] = boot_weights.mean()
+        df_comp["boot_weight_low"] = boot_weights.quantile(0.025)
+        df_comp["boot_weight_high"] = boot_weights.quantile(0.975)
     return df_comp.sort_values(by=ic, ascending=ascending)
@@ -1,5 +1,29 @@
+import json
+import os
+import shutil
+from glob import glob
+
+import numpy as np
 import pandas as pd
 
+from artifacts import get_file_hash, get_fingerprint, is_fresh, writing
+
+PREPARED_DIR = os.path.join("results", "prepared")
+RAW_COLUMNS = ["Clone", "Plasmid", "Run", "Treatment", "Day", "VCD"]
+FACTOR_COLUMNS = {
+    "design_fct": "design",
+    "design_ab_fct": "design_ab",
+    "design_abc_fct": "design_abc",
+    "clone_fct": "clone",
+    "replicate_fct": "replicate",
+}
+# the models treat design code 1 as the baseline, with no design effect
+BASELINE_DESIGNS = {
+    "design_fct": "Empty",
+    "design_ab_fct": "BASE",
+    "design_abc_fct": "BASE",
+}
+
 DESIGN_AB = {
     "Bak-,Bax-": "AB",
     "Bak-,Bax-,Bok-": "AB",
@@ -34,7 +58,31 @@ def stan_factorize(s_in, first=None):
     return s_in.map(dict(zip(values, codes)))
 
 
+def stan_factorize_by(s_in, by, first=None):
+    """Do stan_factorize separately for each group of values of by, at once.
+
+    Each value's code is its rank, within its group, by position of first
+    appearance, with the value first (if given) ranked first.
+
+    """
+    position = pd.Series(np.arange(len(s_in)), index=s_in.index)
+    first_position = position.groupby([by, s_in]).transform("min")
+    if first is not None:
+        first_position = first_position.where(s_in.ne(first), -1)
+    return first_position.groupby(by).rank(method="dense").astype(int)
+
+
 def prepare_data(raw: pd.DataFrame, treatment: str) -> pd.DataFrame:
+    return prepare_all_data(raw).loc[lambda df: df["treatment"].eq(treatment)]
+
+
+def prepare_all_data(raw: pd.DataFrame) -> pd.DataFrame:
+    """Prepare the data for every treatment, with rows sorted by treatment.
+
+    Factor codes are worked out separately for each treatment, so each
+    treatment's rows are the same as the output of prepare_data.
+
+    """
     return (
         pd.DataFrame(
             {
@@ -46,22 +94,29 @@ def prepare_data(raw: pd.DataFrame, treatment: str) -> pd.DataFrame:
                 "y": raw["VCD"].astype(float),
             }
         )
-        .loc[
-            lambda df: (
-                df["treatment"].eq(treatment)
-                & df["day"].gt(0)
-                & ~df["design"].eq("None")
-            )
-        ]
+        .loc[lambda df: df["day"].gt(0) & ~df["design"].eq("None")]
+        .sort_values("treatment", kind="mergesort")
         .assign(
             baseline=1,
             design_ab=lambda df: df["design"].map(DESIGN_AB),
             design_abc=lambda df: df["design"].map(DESIGN_ABC),
-            design_fct=lambda df: stan_factorize(df["design"], first="Empty"),
-            design_ab_fct=lambda df: stan_factorize(df["design_ab"], first="BASE"),
-            design_abc_fct=lambda df: stan_factorize(df["design_abc"], first="BASE"),
-            clone_fct=lambda df: stan_factorize(df["clone"]),
-            replicate_fct=lambda df: stan_factorize(df["replicate"]),
+            design_fct=lambda df: stan_factorize_by(
+                df["design"], df["treatment"], first=BASELINE_DESIGNS["design_fct"]
+            ),
+            design_ab_fct=lambda df: stan_factorize_by(
+                df["design_ab"],
+                df["treatment"],
+                first=BASELINE_DESIGNS["design_ab_fct"],
+            ),
+            design_abc_fct=lambda df: stan_factorize_by(
+                df["design_abc"],
+                df["treatment"],
+                first=BASELINE_DESIGNS["design_abc_fct"],
+            ),
+            clone_fct=lambda df: stan_factorize_by(df["clone"], df["treatment"]),
+            replicate_fct=lambda df: stan_factorize_by(
+                df["replicate"], df["treatment"]
+            ),
             is_A=lambda df: df["design"].str.contains("Bak"),
             is_B=lambda df: df["design"].str.contains("Bax"),
             is_C=lambda df: df["design"].str.contains("Bok"),
@@ -71,3 +126,204 @@ def prepare_data(raw: pd.DataFrame, treatment: str) -> pd.DataFrame:
             is_ABC=lambda df: df["is_A"] & df["is_B"] & df["is_C"],
         )
     )
+
+
+def validate_raw_data(raw, csv_file, codes):
+    """Check that a raw csv file can be added to the prepared data.
+
+    codes is as for set_stable_codes, so replicates that are already in the
+    prepared data are rejected.
+
+    """
+    missing = [col for col in RAW_COLUMNS if col not in raw.columns]
+    if missing:
+        raise ValueError(f"{csv_file} is missing the columns {missing}.")
+    if raw[RAW_COLUMNS].isna().any().any():
+        raise ValueError(f"{csv_file} has missing values.")
+    unknown = set(raw["Plasmid"]) - set(DESIGN_AB.keys())
+    if unknown:
+        raise ValueError(f"{csv_file} has unknown plasmids {sorted(unknown)}.")
+    replicates = raw["Clone"].str.cat(raw["Run"], sep="-")
+    repeated = sorted(
+        f"{replicate} ({treatment})"
+        for treatment, replicate in set(zip(raw["Treatment"], replicates))
+        if replicate in codes.get(treatment, {}).get("replicate_fct", {})
+    )
+    if repeated:
+        raise ValueError(
+            f"{csv_file} has replicates that were already prepared: {repeated}."
+        )
+
+
+def set_stable_codes(msmts, codes):
+    """Replace the factor codes in msmts with codes that don't change on append.
+
+    codes maps each treatment and factor code column to a dictionary of value:
+    code pairs for the data that are already prepared. Values that are not in
+    codes get new codes after the existing ones, in the order of their codes
+    in msmts, and are added to codes.
+
+    A baseline design in BASELINE_DESIGNS that is new for a treatment with
+    already prepared data would get a code other than 1, so it is rejected.
+
+    """
+    out = msmts.copy()
+    for treatment, rows in msmts.groupby("treatment").groups.items():
+        for fct, col in FACTOR_COLUMNS.items():
+            known = codes.setdefault(treatment, {}).setdefault(fct, {})
+            new = msmts.loc[rows, [col, fct]].drop_duplicates().sort_values(fct)
+            baseline = BASELINE_DESIGNS.get(fct)
+            if len(known) > 0 and baseline in set(new[col]) - set(known):
+                raise ValueError(
+                    f"Baseline design {baseline} is new for treatment {treatment}"
+                    " so it would not get code 1. Its data must be in the first"
+                    " file prepared for the treatment."
+                )
+            for value in new[col]:
+                known.setdefault(value, len(known) + 1)
+            out.loc[rows, fct] = msmts.loc[rows, col].map(known)
+    return out
+
+
+def write_columns(msmts, output_dir):
+    """Save the index and each column of msmts as a numpy array.
+
+    Returns the pandas dtype of each column.
+
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    columns = {"index": msmts.index.to_series(), **dict(msmts.items())}
+    dtypes = {name: str(col.dtype) for name, col in columns.items()}
+    for name, col in columns.items():
+        if dtypes[name] in ["string", "object"]:
+            values = col.to_numpy(dtype=str)
+        elif dtypes[name] == "boolean":
+            values = col.to_numpy(dtype=bool)
+        else:
+            values = col.to_numpy()
+        path = os.path.join(output_dir, f"{name}.npy")
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, values)
+        os.replace(path + ".tmp", path)
+    return dtypes
+
+
+def ingest_csv_file(csv_file, file_hash, chunk_dir, codes, offset):
+    """Prepare the data in a raw csv file and save them in chunk_dir.
+
+    The index of the prepared data is the row number in the raw csv file plus
+    offset. Returns the file's entry in index.json, recording which rows
+    belong to each treatment, and the dtype of each column.
+
+    """
+    raw = pd.read_csv(csv_file)
+    validate_raw_data(raw, csv_file, codes)
+    msmts = set_stable_codes(prepare_all_data(raw), codes)
+    dtypes = write_columns(msmts.set_axis(msmts.index + offset), chunk_dir)
+    treatments, starts, counts = np.unique(
+        msmts["treatment"].to_numpy(dtype=str), return_index=True, return_counts=True
+    )
+    entry = {
+        "file": os.path.basename(csv_file),
+        "hash": file_hash,
+        "chunk": os.path.basename(chunk_dir),
+        "n_raw_rows": len(raw),
+        "treatments": {
+            t: [int(start), int(start + count)]
+            for t, start, count in zip(treatments, starts, counts)
+        },
+    }
+    return entry, dtypes
+
+
+def update_prepared_data(raw_dir, cache_dir=PREPARED_DIR):
+    """Add any new csv files in raw_dir to the prepared data.
+
+    Files are added in order of name and each one is prepared on its own, so
+    the cost of an update depends only on the new files. Factor codes of the
+    data that were already prepared don't change. If a file that was already
+    prepared has changed or gone, or this module has changed, everything is
+    prepared again, in the same order as before.
+
+    Returns the contents of the cache's index.json.
+
+    """
+    index_file = os.path.join(cache_dir, "index.json")
+    file_hashes = {
+        os.path.basename(f): get_file_hash(f)
+        for f in sorted(glob(os.path.join(raw_dir, "*.csv")))
+    }
+    if len(file_hashes) == 0:
+        raise FileNotFoundError(f"There are no csv files in {raw_dir}.")
+    version = get_file_hash(__file__)
+    fingerprint = get_fingerprint(version, file_hashes)
+    index = None
+    if os.path.exists(index_file):
+        with open(index_file, "r") as f:
+            index = json.load(f)
+        if is_fresh(index_file, fingerprint):
+            return index
+    prepared = [] if index is None else [e["file"] for e in index["files"]]
+    if (
+        index is None
+        or index["version"] != version
+        or any(file_hashes.get(e["file"]) != e["hash"] for e in index["files"])
+    ):
+        if index is not None:
+            print("Prepared data are out of date, preparing them again.")
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        index = {"version": version, "dtypes": None, "files": [], "codes": {}}
+        prepared = [f for f in prepared if f in file_hashes]
+        todo = prepared + [f for f in file_hashes.keys() if f not in prepared]
+    else:
+        todo = [f for f in file_hashes.keys() if f not in prepared]
+    for name in todo:
+        print(f"Preparing data from {name}...")
+        entry, index["dtypes"] = ingest_csv_file(
+            os.path.join(raw_dir, name),
+            file_hashes[name],
+            os.path.join(cache_dir, f"chunk_{len(index['files'])}"),
+            index["codes"],
+            sum(e["n_raw_rows"] for e in index["files"]),
+        )
+        index["files"].append(entry)
+    with writing(index_file, fingerprint):
+        with open(index_file + ".tmp", "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(index_file + ".tmp", index_file)
+    return index
+
+
+def load_prepared_data(raw_dir, treatment, cache_dir=PREPARED_DIR):
+    """Get one treatment's prepared data, preparing any new raw data first.
+
+    Only the treatment's rows of each memory-mapped column are read.
+
+    """
+    index = update_prepared_data(raw_dir, cache_dir)
+    chunks = [
+        (os.path.join(cache_dir, e["chunk"]), *e["treatments"][treatment])
+        for e in index["files"]
+        if treatment in e["treatments"]
+    ]
+    if len(chunks) == 0:
+        raise ValueError(f"There are no data for treatment {treatment}.")
+    return (
+        pd.concat(
+            [
+                pd.DataFrame(
+                    {
+                        name: np.load(
+                            os.path.join(chunk_dir, f"{name}.npy"), mmap_mode="r"
+                        )[start:stop]
+                        for name in index["dtypes"].keys()
+                    }
+                )
+                for chunk_dir, start, stop in chunks
+            ],
+            ignore_index=True,
+        )
+        .astype(index["dtypes"])
+        .set_index("index")
+        .rename_axis(None)
+    )
@@ -0,0 +1,84 @@
+"""Timings of a fit's python stages and of its Stan profile statements.
+
+The models have named profile statements around the priors, the likelihood,
+and within the likelihood around yt, the error model and the lognormal
+densities, and around the generated quantities. stan_models.ProfiledModel
+makes CmdStan write each chain's profile to a file next to its csv output.
+fit_models times its own stages with timed, and get_profile_report merges
+both into one table per run.
+
+"""
+import os
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+from stan_models import get_profile_file
+
+STAN_PROFILE_COLUMNS = {
+    "total_time": "seconds",
+    "forward_time": "forward_seconds",
+    "reverse_time": "reverse_seconds",
+    "autodiff_calls": "autodiff_calls",
+    "no_autodiff_calls": "no_autodiff_calls",
+}
+
+
+@contextmanager
+def timed(timings, stage):
+    """Record the number of seconds the context takes in timings[stage]."""
+    start = time.perf_counter()
+    yield
+    timings[stage] = time.perf_counter() - start
+
+
+def read_stan_profiles(csv_files):
+    """Read the profiles of some CmdStan runs, e.g. the chains of a fit.
+
+    Returns a dataframe with a row per profile name and run, with the times
+    and counts summed over threads. Runs without a profile are left out.
+
+    """
+    profiles = [
+        pd.read_csv(get_profile_file(csv_file)).assign(run=i)
+        for i, csv_file in enumerate(csv_files)
+        if os.path.exists(get_profile_file(csv_file))
+    ]
+    if len(profiles) == 0:
+        return pd.DataFrame(columns=["name", "run", *STAN_PROFILE_COLUMNS]).astype(
+            {c: float for c in STAN_PROFILE_COLUMNS}
+        )
+    return (
+        pd.concat(profiles)
+        .groupby(["name", "run"], sort=False)[list(STAN_PROFILE_COLUMNS)]
+        .sum()
+        .reset_index()
+    )
+
+
+def get_profile_report(timings, csv_files):
+    """Merge python stage timings and the Stan profiles of csv_files.
+
+    Each python stage has a row with source "python" and its wall time. Each
+    Stan profile has a row with source "stan" and its times and counts
+    averaged over the runs, i.e. per chain for a fit's csv files.
+
+    """
+    stan = (
+        read_stan_profiles(csv_files)
+        .groupby("name", sort=False)[list(STAN_PROFILE_COLUMNS)]
+        .mean()
+        .rename(columns=STAN_PROFILE_COLUMNS)
+        .assign(source="stan")
+    )
+    python = pd.DataFrame(
+        {"seconds": pd.Series(timings, dtype=float), "source": "python"}
+    )
+    return (
+        pd.concat([python, stan])
+        .rename_axis("name")
+        .reset_index()
+        .set_index(["source", "name"])
+        .reindex(columns=list(STAN_PROFILE_COLUMNS.values()))
+    )
@@ -1,15 +1,21 @@
+import argparse
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import arviz as az
+import numpy as np
 import pandas as pd
-from cmdstanpy import CmdStanModel
+from arviz.stats.stats_utils import logsumexp
 
-from fit_models import (CSV_FILE, INFD_DIR, LOO_DIR, MODEL_SETS, OUTPUT_DIR,
-                        PRIORS, STAN_FILES, TREATMENT_TO_MODEL_SET, TREATMENTS,
-                        get_infd_kwargs, get_stan_input)
+from artifacts import get_fingerprint, is_fresh, read_fingerprint, writing
+from fit_models import (INFD_DIR, LOO_DIR, OUTPUT_DIR, PRIORS, RAW_DATA_DIR,
+                        SAMPLES_DIR, STAN_FILES, TREATMENTS, StanData,
+                        get_comparison_name, get_infd_kwargs, get_runs)
 from loo_compare import compare
-from munging import prepare_data
+from munging import load_prepared_data
+from stan_models import get_model, write_stan_json
+from stream_netcdf import open_infd
 
 SAMPLE_CONFIG = dict(
     show_progress=False,
@@ -20,19 +26,84 @@ SAMPLE_CONFIG = dict(
     chains=1,
     seed=12345,
 )
+WARM_START_ITER_WARMUP = 50
+WARM_START_CONFIG = dict(
+    iter_warmup=WARM_START_ITER_WARMUP,
+    # the whole warmup is the terminal buffer, so only the step size is adapted
+    # and the original fit's inverse metric is kept
+    adapt_init_phase=0,
+    adapt_metric_window=0,
+    adapt_step_size=WARM_START_ITER_WARMUP,
+)
+METRIC_RTOL = 1e-4  # CmdStan writes the inverse metric with 6 digits
+PARAMETERS = [
+    "mu_err",
+    "b_err",
+    "R0",
+    "qconst",
+    "dconst",
+    "tconst",
+    "mu",
+    "dq_free",
+    "dt_free",
+    "dd_free",
+    "cq",
+    "cd",
+    "ct",
+    # the reparameterised models' parameters
+    "qcentre",
+    "tcentre",
+    "dcentre",
+    "cq_mean",
+    "cd_mean",
+    "ct_mean",
+    "cq_dev",
+    "cd_dev",
+    "ct_dev",
+]
 K_THRESHOLD = 0.7
+SCALE_VALUES = {"deviance": -2, "log": 1, "negative_log": -1}
 
 
 class CustomSamplingWrapper(az.SamplingWrapper):
-    def __init__(self, msmts, priors, design_col, **super_kwargs):
-        self.msmts = msmts
+    def __init__(self, stan_data, priors, data_dir, warm_start=None, **super_kwargs):
+        self.stan_data = stan_data
         self.priors = priors
-        self.design_col = design_col
+        self.data_dir = data_dir
+        self.warm_start = warm_start
         super(CustomSamplingWrapper, self).__init__(**super_kwargs)
+        self.rng = np.random.default_rng(self.sample_kwargs.get("seed"))
+
+    def get_sample_kwargs(self, **overrides):
+        """Get arguments for CmdStanModel.sample, warm-started if possible.
+
+        A warm-started refit starts from a random draw from the original
+        posterior and reuses the original fit's step size and inverse metric,
+        so it only needs a short warmup.
+
+        """
+        out = {**self.sample_kwargs, **overrides}
+        if self.warm_start is not None:
+            posterior = self.idata_orig.posterior
+            chain = self.rng.integers(posterior.sizes["chain"])
+            draw = self.rng.integers(posterior.sizes["draw"])
+            out.update(WARM_START_CONFIG)
+            out["inits"] = {
+                p: posterior[p].isel(chain=chain, draw=draw).values.tolist()
+                for p in PARAMETERS
+                if p in posterior
+            }
+            out["step_size"] = self.warm_start["step_size"]
+            out["metric"] = self.warm_start["metric"]
+        return out
 
     def sample(self, data):
-        """Call CmdStanModel.sample."""
-        return self.model.sample(data=data, **self.sample_kwargs)
+        """Call CmdStanModel.sample, checking that a warm start's metric is kept."""
+        sample_kwargs = self.get_sample_kwargs()
+        mcmc = self.model.sample(data=data, **sample_kwargs)
+        if "metric" in sample_kwargs:
+            check_metric(mcmc, sample_kwargs["metric"])
+        return mcmc
 
     def get_inference_data(self, mcmc):
         """Call arviz.from_cmdstanpy."""
@@ -44,37 +115,204 @@ class CustomSamplingWrapper(az.SamplingWrapper):
         return ll.where(ll != 0, drop=True)
 
     def sel_observations(self, idx):
-        """Construct a stan input where replicate idx is out-of-sample."""
-        original = get_stan_input(self.msmts, self.priors, self.design_col)
-        m_test = self.msmts.loc[lambda df: df["replicate_fct"].eq(idx[0] + 1)]
-        m_train = self.msmts.drop(m_test.index)
-        d_test = original.copy()
-        d_test["t"] = m_train["day"].values
-        d_test["t_test"] = m_test["day"].values
-        d_test["y"] = m_train["y"].values
-        d_test["y_test"] = m_test["y"].values
-        d_test["replicate"] = m_train["replicate_fct"].values
-        d_test["replicate_test"] = m_test["replicate_fct"].values
-        d_test["N"] = len(m_train)
-        d_test["N_test"] = len(m_test)
-        return d_test, {}
-
-
-def main():
+        """Write a stan input where replicate idx is out-of-sample.
+
+        Returns the path of the json file, which CmdStan reads directly.
+
+        """
+        d_test = self.stan_data.get_input(self.priors, test_replicates=[idx[0] + 1])
+        json_file = os.path.join(self.data_dir, f"input_data_{idx[0] + 1}.json")
+        os.makedirs(self.data_dir, exist_ok=True)
+        write_stan_json(json_file, d_test)
+        return json_file, {}
+
+
+def check_metric(mcmc, metric_file):
+    """Check that a fit sampled with the inverse metric in metric_file."""
+    with open(metric_file, "r") as f:
+        inv_metric = np.array(json.load(f)["inv_metric"])
+    if not np.allclose(mcmc.metric, inv_metric, rtol=METRIC_RTOL, atol=0):
+        raise ValueError(
+            f"Fit's inverse metric {mcmc.metric} differs from the warm start's "
+            f"inverse metric {inv_metric} in {metric_file}."
+        )
+
+
+def refit(model, data, sample_kwargs, idata_kwargs):
+    """Get out-of-sample log likelihoods from a fit to some held-out data."""
+    sw = CustomSamplingWrapper(
+        model=model,
+        sample_kwargs=sample_kwargs,
+        idata_kwargs=idata_kwargs,
+        stan_data=None,
+        priors=None,
+        data_dir=None,
+    )
+    idata = sw.get_inference_data(sw.sample(data))
+    return sw.log_likelihood__i(None, idata).values.flatten()
+
+
+def reloo_refits(wrapper, loo_orig, k_thresh, n_workers, output_dir):
+    """Do the same thing as arviz.reloo, one refit at a time or concurrently.
+
+    The refits are done in this process if n_workers is None, otherwise in a
+    pool of n_workers processes. Each refit gets its own subdirectory of
+    output_dir and a seed that depends only on its replicate, so the results
+    don't depend on n_workers.
+
+    """
+    loo_refitted = loo_orig.copy()
+    khats = loo_refitted.pareto_k
+    loo_i = loo_refitted.loo_i
+    scale_value = SCALE_VALUES[loo_orig.loo_scale.lower()]
+    lppd_orig = loo_orig.p_loo + loo_orig.loo / scale_value
+    n_data_points = loo_orig.n_data_points
+    idxs = np.argwhere(khats.values > k_thresh)
+    if len(idxs) == 0:
+        print("No problematic observations")
+        return loo_orig
+    refit_args = {}
+    for idx in idxs:
+        new_obs, _ = wrapper.sel_observations(idx)
+        sample_kwargs = wrapper.get_sample_kwargs(
+            seed=wrapper.sample_kwargs["seed"] + int(idx[0]) + 1,
+            output_dir=os.path.join(output_dir, f"replicate_{idx[0] + 1}"),
+        )
+        refit_args[tuple(idx)] = (
+            wrapper.model,
+            new_obs,
+            sample_kwargs,
+            wrapper.idata_kwargs,
+        )
+    if n_workers is None:
+        log_likes = {idx: refit(*args) for idx, args in refit_args.items()}
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                idx: executor.submit(refit, *args) for idx, args in refit_args.items()
+            }
+            log_likes = {idx: future.result() for idx, future in futures.items()}
+    for idx, log_like_idx in log_likes.items():
+        khats[idx] = 0
+        loo_i[idx] = scale_value * logsumexp(log_like_idx, b_inv=len(log_like_idx))
+    loo_refitted.loo = loo_i.values.sum()
+    loo_refitted.loo_se = (n_data_points * np.var(loo_i.values)) ** 0.5
+    loo_refitted.p_loo = lppd_orig - loo_refitted.loo / scale_value
+    return loo_refitted
+
+
+def get_warm_start(adapt_file, metric_file):
+    """Get a warm start from the adaptation info saved by fit_models.
+
+    The original fit's per-chain step sizes and inverse metrics are averaged,
+    and the inverse metric is written to metric_file for CmdStan to read.
+
+    """
+    with open(adapt_file, "r") as f:
+        adaptation = json.load(f)
+    os.makedirs(os.path.dirname(metric_file), exist_ok=True)
+    write_stan_json(
+        metric_file, {"inv_metric": np.mean(adaptation["inv_metric"], axis=0)}
+    )
+    return {"step_size": float(np.mean(adaptation["stepsize"])), "metric": metric_file}
+
+
+def run_reloo(sw, loo_orig, n_cores, output_dir):
+    """Run reloo one refit at a time, or concurrently if n_cores is given."""
+    n_workers = None
+    if n_cores is not None:
+        n_workers = max(n_cores // SAMPLE_CONFIG["chains"], 1)
+    return reloo_refits(
+        sw,
+        loo_orig=loo_orig,
+        k_thresh=K_THRESHOLD,
+        n_workers=n_workers,
+        output_dir=output_dir,
+    )
+
+
+def get_refit_report(loo_orig, rl, rl_cold=None):
+    """Compare elpd estimates for the replicates that were refitted.
+
+    elpd_psis is the original psis-loo estimate and elpd_refit the exact one.
+    If rl_cold is given, elpd_cold is the exact estimate without a warm start
+    and warm_start_change shows how much warm-starting changed the result.
+
+    """
+    refitted = loo_orig.pareto_k.values > K_THRESHOLD
+    dim = loo_orig.loo_i.dims[0]
+    out = pd.DataFrame(
+        {
+            "pareto_k": loo_orig.pareto_k.values[refitted],
+            "elpd_psis": loo_orig.loo_i.values[refitted],
+            "elpd_refit": rl.loo_i.values[refitted],
+        },
+        index=pd.Index(loo_orig.loo_i[dim].values[refitted], name=dim),
+    )
+    if rl_cold is not None:
+        out["elpd_cold"] = rl_cold.loo_i.values[refitted]
+        out["warm_start_change"] = out["elpd_refit"] - out["elpd_cold"]
+    return out
+
+
+def main(
+    n_cores=None,
+    warm_start=False,
+    check_warm_start=False,
+    n_bootstrap=0,
+    reparameterised=False,
+):
+    """Run reloo for every run.
+
+    If n_cores is given, the refits for each run are done concurrently using
+    that many cores, otherwise they are done one at a time. Either way each
+    refit has the same seed, so n_cores doesn't change the results.
+
+    If warm_start is True, refits start from the original posterior rather
+    than from scratch. If check_warm_start is also True, every refit is done
+    again without a warm start so that the two can be compared.
+
+    If n_bootstrap is more than 0, the comparison also has pseudo-BMA+ weights
+    and bootstrap intervals for the stacking weights.
+
+    If reparameterised is True, the reparameterised models' runs are used and
+    compared instead.
+
+    """
     for treatment_label, treatment in TREATMENTS.items():
         loos = {}
-        for model_name, xname in MODEL_SETS[TREATMENT_TO_MODEL_SET[treatment_label]]:
+        for model_name, xname in get_runs(treatment_label, reparameterised):
             stan_file = STAN_FILES[model_name]
             design_col = "design_" + xname
             run_name = f"{treatment_label}_{model_name}_{xname}"
             loo_file = os.path.join(LOO_DIR, f"loo_{run_name}.pkl")
             infd_file = os.path.join(INFD_DIR, f"infd_{run_name}.nc")
             json_file = os.path.join(OUTPUT_DIR, f"input_data_{run_name}.json")
+            adapt_file = os.path.join(INFD_DIR, f"adapt_{run_name}.json")
+            reloo_file = os.path.join(LOO_DIR, f"reloo_{run_name}.pkl")
+            report_file = os.path.join(LOO_DIR, f"reloo_refits_{run_name}.csv")
+            output_dir = os.path.join(SAMPLES_DIR, f"reloo_{run_name}")
+            if not os.path.exists(loo_file):
+                print(f"Model {run_name} has no psis-loo results, skipping reloo.")
+                continue
+            fingerprint = get_fingerprint(
+                read_fingerprint(infd_file),
+                read_fingerprint(loo_file),
+                read_fingerprint(adapt_file) if warm_start else None,
+                SAMPLE_CONFIG,
+                WARM_START_CONFIG if warm_start else None,
+                warm_start and check_warm_start,
+                K_THRESHOLD,
+            )
+            if all(is_fresh(f, fingerprint) for f in [reloo_file, report_file]):
+                print(f"Inputs unchanged for model {run_name}, not rerunning reloo.")
+                loos[run_name] = pd.read_pickle(reloo_file)
+                continue
             print(f"Running reloo analysis for model {run_name}...")
-            model = CmdStanModel(stan_file=stan_file)
-            msmts = prepare_data(pd.read_csv(CSV_FILE), treatment=treatment)
+            model = get_model(stan_file)
+            msmts = load_prepared_data(RAW_DATA_DIR, treatment)
             loo_orig = pd.read_pickle(loo_file)
-            infd_orig = az.from_netcdf(infd_file)
+            infd_orig = open_infd(infd_file, {"posterior": PARAMETERS})
             with open(json_file, "r") as f:
                 stan_input = json.load(f)
             infd_kwargs = get_infd_kwargs(msmts, design_col, stan_input)
@@ -83,20 +321,80 @@ def main():
                 idata_orig=infd_orig,
                 sample_kwargs=SAMPLE_CONFIG,
                 idata_kwargs=infd_kwargs,
-                msmts=msmts,
+                stan_data=StanData(msmts, design_col),
                 priors=PRIORS,
-                design_col=design_col,
+                data_dir=os.path.join(output_dir, "input_data"),
             )
-            rl = az.reloo(sw, loo_orig=loo_orig, k_thresh=K_THRESHOLD)
-            rl.to_pickle(os.path.join(LOO_DIR, f"reloo_{run_name}.pkl"))
+            rl_cold = None
+            if warm_start:
+                if check_warm_start:
+                    rl_cold = run_reloo(sw, loo_orig, n_cores, output_dir + "_cold")
+                sw.warm_start = get_warm_start(
+                    adapt_file, os.path.join(output_dir, "metric.json")
+                )
+            rl = run_reloo(sw, loo_orig, n_cores, output_dir)
+            report = get_refit_report(loo_orig, rl, rl_cold)
+            print(report)
+            if rl_cold is not None:
+                max_change = report["warm_start_change"].abs().max()
+                print(f"Largest change in elpd due to warm start: {max_change}")
+            with writing(report_file, fingerprint):
+                report.to_csv(report_file)
+            with writing(reloo_file, fingerprint):
+                rl.to_pickle(reloo_file)
             loos[run_name] = rl
-        comparison = compare(loos)
+        comparison_name = get_comparison_name(treatment_label, reparameterised)
+        comparison_file = os.path.join(
+            LOO_DIR, f"reloo_comparison_{comparison_name}.csv"
+        )
+        comparison = compare(loos, n_bootstrap, n_cores or 1)
         print(f"Loo comparison for model {treatment_label}:")
         print(comparison)
-        comparison.to_csv(
-            os.path.join(LOO_DIR, f"reloo_comparison_{treatment_label}.csv")
+        comparison_fingerprint = get_fingerprint(
+            [
+                read_fingerprint(os.path.join(LOO_DIR, f"reloo_{run_name}.pkl"))
+                for run_name in loos.keys()
+            ],
+            n_bootstrap,
         )
+        with writing(comparison_file, comparison_fingerprint):
+            comparison.to_csv(comparison_file)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Run reloo for all models.")
+    parser.add_argument(
+        "--cores",
+        type=int,
+        default=None,
+        help="Do refits concurrently using this many cores.",
+    )
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help="Start refits from the original posterior and adaptation.",
+    )
+    parser.add_argument(
+        "--check-warm-start",
+        action="store_true",
+        help="Also do cold refits and report the warm start's effect on elpd.",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        help="Number of bootstrap draws for pseudo-BMA+ and stacking weights.",
+    )
+    parser.add_argument(
+        "--reparameterised",
+        action="store_true",
+        help="Use the reparameterised versions of the models.",
+    )
+    args = parser.parse_args()
+    main(
+        n_cores=args.cores,
+        warm_start=args.warm_start or args.check_warm_start,
+        check_warm_start=args.check_warm_start,
+        n_bootstrap=args.bootstrap,
+        reparameterised=args.reparameterised,
+    )
@@ -0,0 +1,148 @@
+"""Compile-once registry of Stan models.
+
+Each model is compiled into its own directory under STAN_CACHE_DIR, named
+after a hash of the model's source code, the source code of any files it
+includes, the C++ compiler options and the CmdStan installation. Any script or
+worker process asking for the same model therefore gets the same executable,
+and a model is only recompiled when something that affects its executable
+changes.
+
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from cmdstanpy import CmdStanModel
+from cmdstanpy.utils import EXTENSION, cmdstan_path
+
+STAN_CACHE_DIR = ".stan_cache"
+PROFILE_DIR = "profiles"
+INCLUDE_REGEX = re.compile(r"^\s*#include\s+[<\"]?([^\s>\"]+)", re.MULTILINE)
+
+
+def get_included_files(stan_file):
+    """Find the files that a Stan program includes, recursively."""
+    with open(stan_file, "r") as f:
+        code = f.read()
+    out = []
+    for include in INCLUDE_REGEX.findall(code):
+        path = os.path.join(os.path.dirname(stan_file), include)
+        out += [path] + get_included_files(path)
+    return out
+
+
+def get_model_hash(stan_file, cpp_options=None):
+    """Hash everything that affects a Stan model's executable."""
+    h = hashlib.sha256()
+    for path in [stan_file] + get_included_files(stan_file):
+        h.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            h.update(f.read())
+    h.update(json.dumps(cpp_options or {}, sort_keys=True).encode())
+    h.update(os.path.realpath(cmdstan_path()).encode())
+    return h.hexdigest()[:16]
+
+
+def get_profile_file(csv_file):
+    """Get the profile file of the CmdStan run whose output is csv_file."""
+    return os.path.join(
+        os.path.dirname(csv_file), PROFILE_DIR, os.path.basename(csv_file)
+    )
+
+
+class ProfiledModel(CmdStanModel):
+    """A CmdStanModel that writes each run's profile next to its output.
+
+    By default CmdStan writes the timings of a model's profile statements to
+    profile.csv in the working directory, so chains and fits running at the
+    same time would overwrite each other's. cmdstanpy 0.9.67 can't change the
+    profile file, so the argument is added to each run's command here.
+
+    """
+
+    def _run_cmdstan(self, runset, idx=0, pbar=None):
+        cmd = runset.cmds[idx]
+        if not any(arg.startswith("profile_file=") for arg in cmd):
+            profile_file = get_profile_file(runset.csv_files[idx])
+            os.makedirs(os.path.dirname(profile_file), exist_ok=True)
+            cmd.insert(cmd.index("output") + 1, f"profile_file={profile_file}")
+        super()._run_cmdstan(runset, idx, pbar)
+
+
+def get_model(stan_file, cpp_options=None, logger=None, cache_dir=STAN_CACHE_DIR):
+    """Get a CmdStanModel, compiling it only if it is not in the cache.
+
+    Compilation happens in a temporary directory which is then renamed, so
+    that concurrent callers never see a half-built cache entry. If two
+    processes compile the same model at once, the loser's build is discarded.
+    Passing an empty cache_dir forces a compilation, e.g. to time it.
+
+    """
+    name = os.path.splitext(os.path.basename(stan_file))[0]
+    model_dir = os.path.join(
+        cache_dir, f"{name}-{get_model_hash(stan_file, cpp_options)}"
+    )
+    cached_stan_file = os.path.join(model_dir, os.path.basename(stan_file))
+    exe_file = os.path.join(model_dir, name + EXTENSION)
+    if not os.path.exists(exe_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        build_dir = tempfile.mkdtemp(prefix=f"{name}-", dir=cache_dir)
+        for path in [stan_file] + get_included_files(stan_file):
+            target = os.path.join(
+                build_dir, os.path.relpath(path, os.path.dirname(stan_file))
+            )
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy(path, target)
+        CmdStanModel(
+            stan_file=os.path.join(build_dir, os.path.basename(stan_file)),
+            cpp_options=cpp_options,
+            logger=logger,
+        )
+        try:
+            os.rename(build_dir, model_dir)
+        except OSError:
+            shutil.rmtree(build_dir)
+    return ProfiledModel(
+        stan_file=cached_stan_file,
+        exe_file=exe_file,
+        cpp_options=cpp_options,
+        logger=logger,
+    )
+
+
+def write_stan_json(path, data):
+    """Write a dictionary of Stan data to a json file CmdStan can read.
+
+    Does the same as cmdstanpy.utils.jsondump, but encodes everything in one
+    go rather than streaming it to the file, which is several times faster.
+
+    """
+    data = {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in data.items()}
+    with open(path, "w") as f:
+        f.write(json.dumps(data))
+
+
+def build_models(stan_files, cpp_options=None):
+    """Compile several models at the same time."""
+    with ThreadPoolExecutor(max_workers=len(stan_files)) as executor:
+        futures = [
+            executor.submit(get_model, stan_file, cpp_options)
+            for stan_file in stan_files
+        ]
+        return [future.result() for future in futures]
+
+
+def main():
+    from fit_models import STAN_FILES
+
+    for model in build_models(list(STAN_FILES.values())):
+        print(f"Compiled {model.stan_file} to {model.exe_file}")
+
+
+if __name__ == "__main__":
+    main()
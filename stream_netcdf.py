@@ -0,0 +1,245 @@
+"""Convert CmdStan output csv files to an arviz-compatible netcdf file.
+
+The csv files are read a chunk of draws at a time and each chunk is written
+straight into compressed, chunked netcdf variables, so peak memory depends on
+the chunk size and the number of columns, but not on the number of draws.
+
+The output has the same groups, variable names and dimensions as
+az.from_cmdstanpy(...).to_netcdf(...), so it can be read with az.from_netcdf.
+open_infd reads such files more selectively, opening only the groups and
+variables that are asked for.
+
+"""
+import re
+from datetime import datetime
+
+import arviz as az
+import netCDF4 as nc
+import numpy as np
+import xarray as xr
+
+CHUNK_DRAWS = 100
+COMPLEVEL = 4
+SAMPLE_STATS = {
+    "lp__": ("lp", np.float64),
+    "accept_stat__": ("acceptance_rate", np.float64),
+    "stepsize__": ("step_size", np.float64),
+    "treedepth__": ("tree_depth", np.int64),
+    "n_leapfrog__": ("n_steps", np.int64),
+    "divergent__": ("diverging", bool),
+    "energy__": ("energy", np.float64),
+}
+
+
+def get_variable_columns(column_names):
+    """Group Stan csv columns by variable.
+
+    Column names can be as in CmdStan csv files (e.g. "x.1.2") or as in
+    cmdstanpy (e.g. "x[1,2]"). Returns a dictionary mapping each variable's
+    name to the positions of its columns and its shape. Columns come in Stan's
+    column-major order, so a variable's values should be reshaped with
+    order="F".
+
+    """
+    out = {}
+    for i, col in enumerate(column_names):
+        name = re.split(r"[\[.]", col)[0]
+        out.setdefault(name, ([], []))[0].append(i)
+        out[name][1][:] = [int(j) for j in re.findall(r"\d+", col[len(name) :])]
+    return {name: (np.array(cols), tuple(shape)) for name, (cols, shape) in out.items()}
+
+
+def read_csv_chunks(csv_file, chunk_draws=CHUNK_DRAWS):
+    """Read a CmdStan csv file, yielding its header then arrays of draws."""
+    with open(csv_file, "r") as f:
+        lines = (line for line in f if not line.startswith("#") and line.strip())
+        yield next(lines).strip().split(",")
+        chunk = []
+        for line in lines:
+            chunk.append(line.split(","))
+            if len(chunk) == chunk_draws:
+                yield np.array(chunk, dtype=float)
+                chunk = []
+        if chunk:
+            yield np.array(chunk, dtype=float)
+
+
+def get_dims(name, shape, dims):
+    """Get a variable's dimension names, using arviz's default names if needed."""
+    var_dims = list(dims.get(name, []))
+    return var_dims + [f"{name}_dim_{i}" for i in range(len(var_dims), len(shape))]
+
+
+def create_group(ds, group, n_chains):
+    out = ds.createGroup(group)
+    out.setncattr("created_at", datetime.utcnow().isoformat())
+    out.setncattr("inference_library", "cmdstanpy")
+    out.createDimension("chain", n_chains)
+    out.createDimension("draw", None)
+    out.createVariable("chain", np.int64, ("chain",))[:] = np.arange(n_chains)
+    out.createVariable("draw", np.int64, ("draw",))
+    return out
+
+
+def create_coord(group, dim, size, coords):
+    """Create a dimension and its coordinate variable if it doesn't exist yet."""
+    if dim in group.dimensions:
+        return
+    group.createDimension(dim, size)
+    values = np.asarray(coords[dim]) if dim in coords else np.arange(size)
+    if values.dtype.kind in "OUS":
+        var = group.createVariable(dim, str, (dim,))
+        for i, value in enumerate(values):
+            var[i] = str(value)
+    else:
+        group.createVariable(dim, values.dtype, (dim,))[:] = values
+
+
+def create_draws_variable(group, name, shape, var_dims, coords, dtype, chunk_draws):
+    for dim, size in zip(var_dims, shape):
+        create_coord(group, dim, size, coords)
+    var = group.createVariable(
+        name,
+        np.int8 if dtype is bool else dtype,
+        ("chain", "draw", *var_dims),
+        zlib=True,
+        complevel=COMPLEVEL,
+        chunksizes=(1, chunk_draws, *shape),
+    )
+    if dtype is bool:
+        var.setncattr("dtype", "bool")
+    return var
+
+
+def write_data_group(ds, group_name, data, coords, dims):
+    """Write a group without chain and draw dimensions, e.g. observed_data."""
+    group = ds.createGroup(group_name)
+    group.setncattr("created_at", datetime.utcnow().isoformat())
+    group.setncattr("inference_library", "cmdstanpy")
+    for name, values in data.items():
+        values = np.asarray(values)
+        var_dims = get_dims(name, values.shape, dims)
+        for dim, size in zip(var_dims, values.shape):
+            create_coord(group, dim, size, coords)
+        if values.dtype.kind in "OUS":
+            var = group.createVariable(name, str, var_dims)
+            for i, value in np.ndenumerate(values):
+                var[i] = str(value)
+        else:
+            group.createVariable(name, values.dtype, var_dims)[:] = values
+
+
+def stream_to_netcdf(
+    csv_files,
+    nc_file,
+    coords=None,
+    dims=None,
+    log_likelihood=None,
+    posterior_predictive=None,
+    predictions=None,
+    observed_data=None,
+    predictions_constant_data=None,
+    draw_index=None,
+    chunk_draws=CHUNK_DRAWS,
+    **kwargs,
+):
+    """Write the draws in some CmdStan csv files to nc_file.
+
+    Each item of csv_files is a chain, given either as one csv file or as a
+    list of csv files holding consecutive draws of the same chain.
+
+    The keyword arguments are the same as for az.from_cmdstanpy, so the output
+    of fit_models.get_infd_kwargs can be passed straight through. Other
+    keyword arguments, e.g. save_warmup, are ignored: only the draws that are
+    in the csv files are written.
+
+    draw_index sets the draw coordinate, e.g. to the draws' positions in
+    the original chain if the csv files hold a thinned subset of draws.
+
+    """
+    coords = {} if coords is None else coords
+    dims = {} if dims is None else dims
+    group_of = {
+        log_likelihood: "log_likelihood",
+        posterior_predictive: "posterior_predictive",
+        predictions: "predictions",
+    }
+    with nc.Dataset(nc_file, mode="w") as ds:
+        groups = {}
+        variables = None
+        for chain, chain_files in enumerate(csv_files):
+            if isinstance(chain_files, str):
+                chain_files = [chain_files]
+            start = 0
+            for csv_file in chain_files:
+                chunks = read_csv_chunks(csv_file, chunk_draws)
+                columns = get_variable_columns(next(chunks))
+                if variables is None:
+                    variables = {}
+                    for name, (cols, shape) in columns.items():
+                        if name in SAMPLE_STATS:
+                            group_name = "sample_stats"
+                            var_name, dtype = SAMPLE_STATS[name]
+                        elif name.endswith("__"):
+                            continue
+                        else:
+                            group_name = group_of.get(name, "posterior")
+                            var_name, dtype = name, np.float64
+                        if group_name not in groups:
+                            groups[group_name] = create_group(
+                                ds, group_name, len(csv_files)
+                            )
+                        variables[name] = create_draws_variable(
+                            groups[group_name],
+                            var_name,
+                            shape,
+                            get_dims(var_name, shape, dims),
+                            coords,
+                            dtype,
+                            chunk_draws,
+                        )
+                for chunk in chunks:
+                    end = start + len(chunk)
+                    for name, var in variables.items():
+                        cols, shape = columns[name]
+                        values = chunk[:, cols].reshape((len(chunk), *shape), order="F")
+                        var[chain, start:end] = values.astype(var.dtype)
+                    start = end
+        for group in groups.values():
+            n_draws = len(group.dimensions["draw"])
+            group.variables["draw"][:] = (
+                np.arange(n_draws) if draw_index is None else draw_index
+            )
+        if observed_data is not None:
+            write_data_group(ds, "observed_data", observed_data, coords, dims)
+        if predictions_constant_data is not None:
+            write_data_group(
+                ds,
+                "predictions_constant_data",
+                predictions_constant_data,
+                coords,
+                dims,
+            )
+
+
+def open_infd(nc_file, var_names):
+    """Lazily open some variables from an arviz netcdf file.
+
+    var_names maps group names to lists of variable names, or to None for
+    all of a group's variables. Missing groups and variables are left out,
+    but every coordinate of an opened group is kept. Nothing is decoded until
+    a variable's values are used, and then only that variable's chunks are
+    read.
+
+    """
+    with nc.Dataset(nc_file, mode="r") as ds:
+        available = list(ds.groups.keys())
+    groups = {}
+    for group, names in var_names.items():
+        if group not in available:
+            continue
+        data = xr.open_dataset(nc_file, group=group)
+        if names is not None:
+            data = data.drop_vars([v for v in data.data_vars if v not in names])
+        groups[group] = data
+    return az.InferenceData(**groups)
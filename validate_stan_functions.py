@@ -1,27 +1,199 @@
-from cmdstanpy import CmdStanModel
+"""Check the analytic solution yt in functions.stan against the ode solution.
+
+Parameter sets are drawn from the priors in fit_models.PRIORS, with some extra
+sets where mu - kq or mu - kq + kd is close to zero, as the analytic solution
+divides by these. Each set gets time points spread over the experiment plus
+two just either side of its td. The sets are split into batches, and each
+batch is evaluated with validation_model.stan in one fixed_param run, once
+with the analytic yt and once with the ode-based yt_num. The CmdStan runs are
+separate processes, n_cores of which run at the same time. The numpy version
+in analytic_solution.py is checked against yt_num too.
+
+The largest relative error in each region of time and parameter space is
+printed and saved in BENCHMARK_DIR, along with the time that each solution
+took.
+
+"""
+import argparse
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from cmdstanpy.utils import get_logger
+
+from analytic_solution import yt
+from benchmark_gradients import BENCHMARK_DIR, get_elapsed_time
+from fit_models import N_CORES, PRIORS, SAMPLES_DIR
+from stan_models import get_model, write_stan_json
+from stream_netcdf import get_variable_columns
 
 STAN_FILE = "validation_model.stan"
-DATA = {
-    "N": 5,
-    "t": [1, 2, 3, 4, 5],
-    "R0": 2.5,
-    "sm": -2.956,
-    "kq": 3.686,
-    "td": 2.839,
-    "kd": 0.499,
-}
+OUTPUT_DIR = os.path.join(SAMPLES_DIR, "validation")
+PARAMETERS = ["R0", "mu", "kq", "td", "kd"]
+METHODS = {"analytic": "y_a", "numeric": "y_n"}
+N_SETS = 4000
+N_TIMES = 12
+BATCH_SIZE = 250
+EDGE_FRACTION = 0.1  # fraction of sets for each kind of edge case
+EDGE_WIDTH = 1e-3  # how close to zero mu - kq or mu - kq + kd is in edge cases
+NEAR = 0.01  # relative or absolute distance counted as close in the report
+MIN_TIME = 0.05
+MAX_TIME = 10
+Y_FLOOR = 1e-3  # smaller ode solutions count as this in relative errors
+SEED = 12345
 SAMPLE_CONFIG = dict(
     fixed_param=True,
     iter_sampling=1,
     iter_warmup=0,
+    chains=1,
+    show_progress=False,
 )
 
-def main():
-   model = CmdStanModel(stan_file=STAN_FILE)
-   mcmc = model.sample(DATA, **SAMPLE_CONFIG)
-   print("input data:\n", DATA)
-   print("results:\n", mcmc.draws_pd().T)
+
+def draw_parameter_sets(n_sets, rng):
+    """Draw parameter sets from the priors, including some edge cases.
+
+    In the first n_sets * EDGE_FRACTION sets kq is changed so that mu - kq is
+    within EDGE_WIDTH of zero. In the next as many sets kq is bigger than mu
+    and kd is changed so that mu - kq + kd is within EDGE_WIDTH of zero.
+
+    """
+    out = {p: rng.lognormal(*PRIORS[f"prior_{p}"], size=n_sets) for p in PARAMETERS}
+    n_edge = int(n_sets * EDGE_FRACTION)
+    edge = slice(0, n_edge)
+    out["kq"][edge] = out["mu"][edge] - rng.uniform(-EDGE_WIDTH, EDGE_WIDTH, n_edge)
+    edge = slice(n_edge, 2 * n_edge)
+    sm = -out["kd"][edge] + rng.uniform(-EDGE_WIDTH, EDGE_WIDTH, n_edge)
+    out["kq"][edge] = out["mu"][edge] - sm
+    return out
+
+
+def get_times(td, rng):
+    """Get sorted time points for each parameter set, two of which are near td."""
+    spread = rng.uniform(MIN_TIME, MAX_TIME, size=(len(td), N_TIMES - 2))
+    near_td = np.column_stack([td * (1 - NEAR / 10), td * (1 + NEAR / 10)])
+    return np.sort(np.column_stack([spread, near_td]), axis=1)
+
+
+def get_regions(t, params):
+    """Get a boolean array for each region of time and parameter space."""
+    sm = (params["mu"] - params["kq"])[:, None]
+    td = params["td"][:, None]
+    out = {
+        "t near td": np.abs(t - td) < NEAR * td,
+        "mu - kq near 0": np.broadcast_to(np.abs(sm) < NEAR, t.shape),
+        "mu - kq + kd near 0": np.broadcast_to(
+            np.abs(sm + params["kd"][:, None]) < NEAR, t.shape
+        ),
+    }
+    edge = np.any(list(out.values()), axis=0)
+    out["other, t < td"] = ~edge & (t < td)
+    out["other, t >= td"] = ~edge & (t >= td)
+    out["all"] = np.ones(t.shape, dtype=bool)
+    return out
+
+
+def read_variable(mcmc, name):
+    """Get a variable's values from the only draw of a fixed_param run."""
+    cols, shape = get_variable_columns(mcmc.column_names)[name]
+    return mcmc.draws()[0, 0, cols].reshape(shape, order="F")
+
+
+def run_batch(model, data, method, output_dir):
+    """Evaluate one batch of parameter sets with yt or yt_num.
+
+    Returns the values and CmdStan's elapsed time.
+
+    """
+    os.makedirs(output_dir)
+    json_file = os.path.join(output_dir, "input_data.json")
+    flags = {m: int(m == method) for m in METHODS}
+    write_stan_json(json_file, {**data, **flags})
+    mcmc = model.sample(data=json_file, output_dir=output_dir, **SAMPLE_CONFIG)
+    return (
+        read_variable(mcmc, METHODS[method]),
+        get_elapsed_time(mcmc.runset.csv_files[0]),
+    )
+
+
+def main(n_sets=N_SETS, n_cores=N_CORES):
+    logger = get_logger()
+    logger.setLevel(40)
+    rng = np.random.default_rng(SEED)
+    params = draw_parameter_sets(n_sets, rng)
+    t = get_times(params["td"], rng)
+    batches = np.array_split(np.arange(n_sets), max(n_sets // BATCH_SIZE, 1))
+    model = get_model(STAN_FILE, logger=logger)
+    shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+    print(f"Evaluating {t.size} time points in {len(batches)} batches...")
+    with ThreadPoolExecutor(max_workers=n_cores) as executor:
+        futures = {
+            method: [
+                executor.submit(
+                    run_batch,
+                    model,
+                    {
+                        "S": len(batch),
+                        "N": N_TIMES,
+                        "t": t[batch],
+                        **{p: params[p][batch] for p in PARAMETERS},
+                    },
+                    method,
+                    os.path.join(OUTPUT_DIR, f"{method}_{i}"),
+                )
+                for i, batch in enumerate(batches)
+            ]
+            for method in METHODS
+        }
+        results = {m: [f.result() for f in fs] for m, fs in futures.items()}
+    y = {m: np.concatenate([r[0] for r in rs]) for m, rs in results.items()}
+    seconds = {m: sum(r[1] for r in rs) for m, rs in results.items()}
+    start = time.perf_counter()
+    y["numpy"] = yt(t, *[params[p][:, None] for p in PARAMETERS])
+    seconds["numpy"] = time.perf_counter() - start
+    denominator = np.maximum(np.abs(y["numeric"]), Y_FLOOR)
+    errors = {
+        m: np.abs(y[m] - y["numeric"]) / denominator for m in ["analytic", "numpy"]
+    }
+    report = pd.DataFrame(
+        [
+            {
+                "region": region,
+                "n": mask.sum(),
+                **{
+                    f"max_rel_error_{m}": np.nanmax(e[mask], initial=0)
+                    for m, e in errors.items()
+                },
+                **{
+                    f"n_not_finite_{m}": (~np.isfinite(y[m][mask])).sum()
+                    for m in errors
+                },
+            }
+            for region, mask in get_regions(t, params).items()
+        ]
+    ).set_index("region")
+    timings = pd.Series(seconds, name="seconds")
+    print(report.to_string())
+    print("Seconds taken:")
+    print(timings.to_string())
+    if seconds["analytic"] > 0:  # CmdStan rounds elapsed times to milliseconds
+        speedup = seconds["numeric"] / seconds["analytic"]
+        print(f"yt was {speedup:.1f}x faster than yt_num.")
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    report.to_csv(os.path.join(BENCHMARK_DIR, "yt_validation.csv"))
+    timings.to_csv(os.path.join(BENCHMARK_DIR, "yt_validation_timings.csv"))
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Check yt against yt_num.")
+    parser.add_argument(
+        "--sets", type=int, default=N_SETS, help="Number of parameter sets."
+    )
+    parser.add_argument(
+        "--cores", type=int, default=N_CORES, help="Number of cores to use."
+    )
+    args = parser.parse_args()
+    main(args.sets, args.cores)